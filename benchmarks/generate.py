@@ -0,0 +1,263 @@
+# generate.py
+# writes synthetic Tagged PDFs for benchmarking pyPDFStructure
+#
+# Usage:
+# python generate.py out.pdf pages=100 depth=3 tables=2 objstm=1
+#
+# Each page has a heading, some paragraphs and tables inside depth nested
+# Sect elements, all under one Document element. Text is shown with two-byte
+# codes through fonts with ToUnicode CMaps, and each piece of marked content
+# is listed in the ParentTree. Parameters (all integers):
+#  pages      number of pages
+#  depth      number of nested Sect elements around each page's content
+#  tables     tables per page, of rows x cols cells (the first row is TH)
+#  rows, cols
+#  paras      paragraphs per page
+#  words      up to this many words in each piece of text (content size)
+#  fonts      number of fonts, each with its own ToUnicode CMap
+#  cmap_extra extra single-code mappings in each CMap (larger CMaps)
+#  objstm     1 to put the dictionaries in object streams with an xref
+#             stream, 0 for a classic xref table
+#  predictor  1 to use a PNG predictor on the xref stream
+#  seed       for the random text
+# The same parameters always give the same file.
+
+import random
+import struct
+import sys
+import zlib
+
+WORDS = ("alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu "
+	"nu xi omicron pi rho sigma tau upsilon phi chi psi omega table report "
+	"total revenue cost income north south east west quarter year").split()
+
+OBJSTM_SIZE = 100 # objects per object stream
+
+class Writer: # the numbered objects of the file, as (dict text, stream data)
+	def __init__(self):
+		self.objs = {}
+		self.next = 1
+
+	def alloc(self):
+		n = self.next
+		self.next += 1
+		return n
+
+	def set(self, n, body, stream=None):
+		self.objs[n] = (body, stream)
+
+def cmap_stream(fi, extra):
+	# each font maps its own block of 256 codes to ASCII
+	lines = ["/CIDInit /ProcSet findresource begin", "12 dict begin", "begincmap",
+		"1 begincodespacerange", "<0000> <FFFF>", "endcodespacerange"]
+	base = 0x100 * (fi + 1)
+	lines.append("1 beginbfrange")
+	lines.append("<%04X> <%04X> <0020>" % (base + 0x20, base + 0x7e))
+	lines.append("endbfrange")
+	for first in range(0, extra, 100): # at most 100 entries per section
+		count = min(100, extra - first)
+		lines.append("%d beginbfchar" % count)
+		for k in range(first, first + count):
+			lines.append("<%04X> <%04X>" % (0x8000 + k, 0x4e00 + k))
+		lines.append("endbfchar")
+	lines += ["endcmap", "CMapName currentdict /CMap defineresource pop", "end", "end"]
+	return "\n".join(lines) + "\n"
+
+def encode(text, fi): # text as hex codes for font fi
+	base = 0x100 * (fi + 1)
+	return "".join("%04X" % (base + ord(c)) for c in text)
+
+def generate(pages=3, depth=2, tables=1, rows=3, cols=3, paras=4, words=8,
+		fonts=2, cmap_extra=0, objstm=0, predictor=0, seed=1):
+	# returns the file as a string
+	rnd = random.Random(seed)
+	w = Writer()
+	catalog = w.alloc()
+	pagesnum = w.alloc()
+	info = w.alloc()
+	root = w.alloc()
+	docelem = w.alloc()
+	parenttree = w.alloc()
+	fontnums = []
+	for fi in range(fonts):
+		fn = w.alloc()
+		cn = w.alloc()
+		fontnums.append(fn)
+		w.set(fn, "<< /Type /Font /Subtype /TrueType /BaseFont /F%d /ToUnicode %d 0 R >>" % (fi, cn))
+		w.set(cn, "<< /Filter /FlateDecode >>", cmap_stream(fi, cmap_extra))
+	fontres = " ".join("/F%d %d 0 R" % (fi + 1, fontnums[fi]) for fi in range(fonts))
+	pagerefs = []
+	sects = []
+	nums = []
+	for p in range(pages):
+		pn = w.alloc()
+		cn = w.alloc()
+		pagerefs.append(pn)
+		content = []
+		owners = [] # the element owning each MCID on the page
+		def mc(role, owner): # show some text as marked content, returns its MCID
+			mcid = len(owners)
+			fi = rnd.randrange(fonts)
+			text = " ".join(rnd.choice(WORDS) for i in range(rnd.randint(1, words)))
+			half = len(text) // 2
+			content.append("/%s <</MCID %d>> BDC" % (role, mcid))
+			content.append("BT")
+			content.append("/F%d 11 Tf" % (fi + 1))
+			content.append("72 %d Td" % (700 - mcid))
+			content.append("[<%s> -20 <%s>] TJ" % (encode(text[:half], fi), encode(text[half:], fi)))
+			content.append("ET")
+			content.append("EMC")
+			owners.append(owner)
+			return mcid
+		def elem(n, role, parent, kids): # StructElem n on this page; kids is text
+			w.set(n, "<< /Type /StructElem /S /%s /P %d 0 R /Pg %d 0 R /K [%s] >>" %
+				(role, parent, pn, kids))
+		sectnums = [w.alloc() for d in range(depth)]
+		inner = sectnums[-1]
+		kids = []
+		h = w.alloc()
+		kids.append(h)
+		elem(h, "H1", inner, str(mc("H1", h)))
+		for q in range(paras):
+			n = w.alloc()
+			elem(n, "P", inner, str(mc("P", n)))
+			kids.append(n)
+		for t in range(tables):
+			tn = w.alloc()
+			trs = []
+			for r in range(rows):
+				trn = w.alloc()
+				tds = []
+				for c in range(cols):
+					tdn = w.alloc()
+					role = "TH" if r == 0 else "TD"
+					elem(tdn, role, trn, str(mc(role, tdn)))
+					tds.append(tdn)
+				elem(trn, "TR", tn, " ".join("%d 0 R" % x for x in tds))
+				trs.append(trn)
+			elem(tn, "Table", inner, " ".join("%d 0 R" % x for x in trs))
+			kids.append(tn)
+		for d in range(depth - 1, -1, -1):
+			parent = docelem if d == 0 else sectnums[d - 1]
+			sectkids = kids if d == depth - 1 else [sectnums[d + 1]]
+			elem(sectnums[d], "Sect", parent, " ".join("%d 0 R" % x for x in sectkids))
+		sects.append(sectnums[0])
+		nums.append("%d [%s]" % (p, " ".join("%d 0 R" % x for x in owners)))
+		w.set(cn, "<< /Filter /FlateDecode >>", "\n".join(content) + "\n")
+		w.set(pn, "<< /Type /Page /Parent %d 0 R /Resources << /Font << %s >> >> "
+			"/Contents %d 0 R /MediaBox [0 0 612 792] /StructParents %d >>" %
+			(pagesnum, fontres, cn, p))
+	w.set(catalog, "<< /Type /Catalog /Pages %d 0 R /StructTreeRoot %d 0 R "
+		"/MarkInfo << /Marked true >> >>" % (pagesnum, root))
+	w.set(pagesnum, "<< /Type /Pages /Kids [%s] /Count %d >>" %
+		(" ".join("%d 0 R" % x for x in pagerefs), pages))
+	w.set(info, "<< /Author (benchmarks) /Creator (generate.py) /CreationDate (D:20150501) "
+		"/ModDate (D:20150501) /Producer (generate.py) >>")
+	w.set(root, "<< /Type /StructTreeRoot /K [%d 0 R] /ParentTree %d 0 R "
+		"/ParentTreeNextKey %d >>" % (docelem, parenttree, pages))
+	w.set(docelem, "<< /Type /StructElem /S /Document /P %d 0 R /K [%s] >>" %
+		(root, " ".join("%d 0 R" % x for x in sects)))
+	w.set(parenttree, "<< /Nums [%s] >>" % " ".join(nums))
+	if objstm:
+		return write_objstm(w, catalog, info, predictor)
+	return write_classic(w, catalog, info)
+
+class Output: # the file being written, and the offset of each object
+	def __init__(self):
+		self.parts = ["%PDF-1.5\n%\xe2\xe3\xcf\xd3\n"]
+		self.pos = len(self.parts[0])
+		self.offsets = {}
+
+	def emit(self, s):
+		self.parts.append(s)
+		self.pos += len(s)
+
+	def emit_obj(self, n, body, stream):
+		self.offsets[n] = self.pos
+		if stream is None:
+			self.emit("%d 0 obj\n%s\nendobj\n" % (n, body))
+			return
+		data = zlib.compress(stream)
+		body = body[:-2] + "/Length %d >>" % len(data)
+		self.emit("%d 0 obj\n%s\nstream\n%s\nendstream\nendobj\n" % (n, body, data))
+
+def write_classic(w, catalog, info): # with an xref table and trailer
+	out = Output()
+	for n in sorted(w.objs):
+		out.emit_obj(n, *w.objs[n])
+	size = w.next
+	xref = out.pos
+	out.emit("xref\n0 %d\n" % size)
+	out.emit("0000000000 65535 f \n")
+	for n in range(1, size):
+		out.emit("%010d 00000 n \n" % out.offsets[n])
+	out.emit("trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R "
+		"/ID [<0123456789ABCDEF><0123456789ABCDEF>] >>\n" % (size, catalog, info))
+	out.emit("startxref\n%d\n%%%%EOF\n" % xref)
+	return "".join(out.parts)
+
+def write_objstm(w, catalog, info, predictor): # with object and xref streams
+	out = Output()
+	compressed = [n for n in sorted(w.objs) if w.objs[n][1] is None]
+	direct = [n for n in sorted(w.objs) if w.objs[n][1] is not None]
+	where = {} # object number -> (object stream, index in it)
+	for i in range(0, len(compressed), OBJSTM_SIZE):
+		part = compressed[i:i + OBJSTM_SIZE]
+		sn = w.alloc()
+		header = []
+		bodies = []
+		offset = 0
+		for (index, n) in enumerate(part):
+			header.append("%d %d" % (n, offset))
+			body = w.objs[n][0] + "\n"
+			bodies.append(body)
+			offset += len(body)
+			where[n] = (sn, index)
+		head = " ".join(header) + "\n"
+		w.set(sn, "<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode >>" %
+			(len(part), len(head)), head + "".join(bodies))
+		direct.append(sn)
+	for n in direct:
+		out.emit_obj(n, *w.objs[n])
+	xn = w.alloc()
+	size = w.next
+	records = []
+	for n in range(size):
+		if n == 0:
+			records.append(struct.pack(">BIH", 0, 0, 65535))
+		elif n in where:
+			records.append(struct.pack(">BIH", 2, where[n][0], where[n][1]))
+		elif n == xn:
+			records.append(struct.pack(">BIH", 1, out.pos, 0))
+		else:
+			records.append(struct.pack(">BIH", 1, out.offsets[n], 0))
+	xref = out.pos
+	extra = ""
+	data = "".join(records)
+	if predictor: # PNG Up predictor: each byte less the one above it
+		columns = len(records[0])
+		rows = []
+		prev = "\0" * columns
+		for record in records:
+			rows.append("\x02" + "".join(chr((ord(c) - ord(p)) & 0xff)
+				for (c, p) in zip(record, prev)))
+			prev = record
+		data = "".join(rows)
+		extra = " /DecodeParms << /Columns %d /Predictor 12 >>" % columns
+	out.emit_obj(xn, "<< /Type /XRef /Size %d /W [1 4 2] /Index [0 %d] /Root %d 0 R "
+		"/Info %d 0 R /ID [<0123456789ABCDEF><0123456789ABCDEF>] /Filter /FlateDecode%s >>" %
+		(size, size, catalog, info, extra), data)
+	out.emit("startxref\n%d\n%%%%EOF\n" % xref)
+	return "".join(out.parts)
+
+def main(args):
+	params = {}
+	for arg in args[1:]:
+		(name, value) = arg.split("=")
+		params[name] = int(value)
+	fout = open(args[0], "wb")
+	fout.write(generate(**params))
+	fout.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,199 @@
+# run.py
+# benchmarks for pyPDFStructure, on files written by generate.py; everything
+# runs offline
+#
+# Usage:
+# python run.py                         run every case, save the results
+# python run.py pages objstm            run only some cases
+# python run.py --compare results/old.json
+#                                       also report changes against an earlier
+#                                       run; exits with 1 on a regression
+#
+# Each case is measured in a fresh process, so its peak memory is its own:
+#  open_s        opening the file with from_path(lazy=True)
+#  index_s       building the structure index (a walk of the whole tree
+#                without decoding any content)
+#  walk_s        iter_structure over the whole tree, decoding all the text
+#  text_chars    characters of text found by the walk
+#  chars_per_s   text_chars / walk_s
+#  walk_peak_kb  peak resident memory after the lazy open and walk
+#  load_s        opening the file eagerly (PDFDocument(data)), which loads
+#                every object
+#  load_peak_kb  peak resident memory after the eager load as well
+# Times are the best of --repeat runs. Results are saved as JSON, by default
+# in results/ under the current git revision.
+
+import gc
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import generate
+
+# (name, generate.generate parameters), in the order they are run
+CASES = [
+	("small", dict(pages=10)),
+	("pages", dict(pages=500)),
+	("deep", dict(pages=50, depth=30)),
+	("tables", dict(pages=50, tables=5, rows=10, cols=6)),
+	("fonts", dict(pages=100, fonts=8, cmap_extra=3000)),
+	("content", dict(pages=100, paras=40, words=60)),
+	("objstm", dict(pages=500, objstm=1)),
+	("objstm-predictor", dict(pages=500, objstm=1, predictor=1)),
+]
+
+TIMINGS = ["open_s", "index_s", "walk_s", "load_s"] # lower is better
+REGRESSION = 0.10 # a timing or peak this much worse than before is reported
+
+def peak_kb(): # peak resident memory of this process
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def best_time(fn, repeat): # the shortest of repeat runs of fn, and its last result
+	best = None
+	result = None
+	for i in range(repeat):
+		# documents refer to themselves through their objects, so they are
+		# only freed by the cycle collector: run it so that runs do not add
+		# to each other's peak memory
+		result = None
+		gc.collect()
+		start = time.time()
+		result = fn()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return (best, result)
+
+def measure(path, repeat): # the measurements of one file, in this process
+	from pyPDFStructure import PDFDocument, MarkedContent
+	results = {"base_kb": peak_kb()}
+	def open_lazy():
+		return PDFDocument.from_path(path, lazy=True)
+	results["open_s"] = best_time(open_lazy, repeat)[0]
+	def build_index():
+		return len(open_lazy().structure_index)
+	(results["index_s"], results["elements"]) = best_time(build_index, repeat)
+	def walk():
+		chars = 0
+		for (depth, kid) in open_lazy().iter_structure(release_pages=True):
+			if isinstance(kid, MarkedContent):
+				chars += len(kid.text)
+		return chars
+	(results["walk_s"], results["text_chars"]) = best_time(walk, repeat)
+	results["chars_per_s"] = int(results["text_chars"] / max(results["walk_s"], 1e-9))
+	results["walk_peak_kb"] = peak_kb()
+	fin = open(path, "rb")
+	data = fin.read()
+	fin.close()
+	results["load_s"] = best_time(lambda: PDFDocument(data), repeat)[0]
+	results["load_peak_kb"] = peak_kb()
+	return results
+
+def run_case(name, params, fixtures, repeat):
+	path = os.path.join(fixtures, name + ".pdf")
+	if not os.path.exists(path):
+		fout = open(path, "wb")
+		fout.write(generate.generate(**params))
+		fout.close()
+	child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+		"--measure", path, str(repeat)], stdout=subprocess.PIPE)
+	(out, err) = child.communicate()
+	if child.returncode != 0:
+		raise Exception("Benchmark case %s failed" % name)
+	results = json.loads(out)
+	results["params"] = params
+	results["file_bytes"] = os.path.getsize(path)
+	return results
+
+def git_revision(): # the current revision of the repository, or None
+	try:
+		out = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+	except OSError:
+		return None
+	return out.strip() or None
+
+def compare(old, new): # print changes between two runs; returns the regressions
+	regressions = []
+	for name in sorted(new["cases"]):
+		if name not in old["cases"]:
+			continue
+		(before, after) = (old["cases"][name], new["cases"][name])
+		for key in TIMINGS + ["walk_peak_kb", "load_peak_kb"]:
+			if not before.get(key) or key not in after:
+				continue
+			ratio = after[key] / float(before[key])
+			flag = ""
+			if ratio > 1 + REGRESSION:
+				flag = "  REGRESSION"
+				regressions.append((name, key, ratio))
+			print "%-18s %-13s %10.4g -> %10.4g  x%.2f%s" % (name, key,
+				before[key], after[key], ratio, flag)
+	return regressions
+
+def main(args):
+	import argparse
+	parser = argparse.ArgumentParser(description="Benchmark pyPDFStructure "
+		"on generated Tagged PDFs.")
+	parser.add_argument("cases", nargs="*", help="cases to run (default: all)")
+	parser.add_argument("-o", "--output", help="where to save the results "
+		"(default: results/<revision>.json)")
+	parser.add_argument("--compare", help="results of an earlier run to compare with")
+	parser.add_argument("--repeat", type=int, default=3, help="runs of each timing")
+	parser.add_argument("--fixtures", help="directory to keep the generated "
+		"files in, so later runs reuse them (default: a temporary directory)")
+	args = parser.parse_args(args)
+	names = [name for (name, params) in CASES]
+	for name in args.cases:
+		if name not in names:
+			parser.error("unknown case %s (choose from %s)" % (name, ", ".join(names)))
+	fixtures = args.fixtures or tempfile.mkdtemp(prefix="pdfbench")
+	if not os.path.isdir(fixtures):
+		os.makedirs(fixtures)
+	revision = git_revision()
+	results = {"revision": revision, "python": sys.version.split()[0],
+		"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "repeat": args.repeat,
+		"cases": {}}
+	try:
+		for (name, params) in CASES:
+			if args.cases and name not in args.cases:
+				continue
+			case = run_case(name, params, fixtures, args.repeat)
+			results["cases"][name] = case
+			print "%-18s open %.4fs  index %.3fs  walk %.3fs  %d chars/s  load %.3fs  peak %dkB" % (
+				name, case["open_s"], case["index_s"], case["walk_s"],
+				case["chars_per_s"], case["load_s"], case["load_peak_kb"])
+	finally:
+		if not args.fixtures:
+			shutil.rmtree(fixtures)
+	output = args.output
+	if output is None:
+		output = os.path.join(HERE, "results",
+			(revision or time.strftime("%Y%m%d-%H%M%S")) + ".json")
+	if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+		os.makedirs(os.path.dirname(output))
+	fout = open(output, "w")
+	json.dump(results, fout, indent=1, sort_keys=True)
+	fout.close()
+	print "saved", output
+	if args.compare:
+		fin = open(args.compare)
+		old = json.load(fin)
+		fin.close()
+		if compare(old, results):
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	if sys.argv[1:2] == ["--measure"]: # in the child process of run_case
+		print json.dumps(measure(sys.argv[2], int(sys.argv[3])))
+	else:
+		sys.exit(main(sys.argv[1:]))
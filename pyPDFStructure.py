@@ -1,18 +1,96 @@
 # pyPDFStructure
 # by Jamie Wood
 # v0.1 May 2015
-# requires zlib and re
+# requires zlib, re and mmap
 #
 # Example Usage:
 # fin = open("mydoc.pdf", "rb")
 # doc = PDFDocument(fin.read())
 #
+# or, to memory-map the file instead of reading it all in:
+# doc = PDFDocument.from_path("mydoc.pdf")
+#
+# Pass lazy=True to only read the cross-reference data when opening the file;
+# pages, fonts, page contents and structure elements are then loaded as they
+# are first accessed.
+#
+# To process large documents in bounded memory, also pass max_objects= and/or
+# cache_bytes= to limit how many loaded objects are kept; see
+# PDFDocument.cache_info() for the cache's hit, miss and eviction counts.
+#
+# Files which are opened again and again can keep their cross-reference data
+# in a sidecar file: PDFDocument.from_path("mydoc.pdf", index_cache=True)
+# writes mydoc.pdf.xrefidx, which is used instead of reading the xref
+# sections on later opens, and rebuilt if the PDF changes.
+#
 # Use PDFDocument.get_structure_tree() to get the top-level Structure element.
 # The rest of the tree may be accessed by using a tree-search on each element's
 # .kids list.
 # Leaf elements will be instances of MarkedContent, and will have a .text field
 # containing the actual text displayed at that location in the structure tree.
 #
+# Alternatively PDFDocument.iter_structure() walks the whole tree without
+# recursion, yielding (depth, element) pairs; see the example at the bottom of
+# this file. With lazy=True and iter_structure(release_pages=True), each page's
+# content is only decoded while the walk is on it.
+#
+# To read only part of a document, PDFDocument.extract(pages=range(40, 46),
+# roles=set(["Table"])) walks just the Tables holding content on those pages
+# (counting from 0), loading only the elements and pages it needs.
+#
+# PDFDocument.find_all("Table") returns every element of a role (after the
+# document's RoleMap) from an index of the tree, which also gives each
+# element's .parent, .depth and .ancestors().
+#
+# For very large trees, PDFDocument.compact_tree() stores the whole tree,
+# text included, in flat arrays (a CompactTree) instead of an object per
+# element; its .root and .iter_structure() give views with the same .kids,
+# .subtype and .text as the full objects, and the document can be closed.
+#
+# PDFDocument.iter_tables() yields each Table as a list of rows of cell text
+# (optionally following RowSpan/ColSpan, or as columns), decoding only the
+# pages its cells are on; write_tables(f) writes them all as CSV.
+#
+# Files which are too large to map, or are on a web server, can be read a
+# block at a time as objects are loaded: PDFDocument.from_source(
+# HTTPSource("http://host/mydoc.pdf"), lazy=True); see ByteSource for reading
+# from elsewhere.
+#
+# When a file has been changed by an incremental update (new objects and
+# xref sections appended to it), doc.reopen_updated(newdata) reads only the
+# new sections and keeps every loaded object which was not changed.
+#
+# On machines with several cores, PDFDocument.from_path("mydoc.pdf",
+# threads=8) inflates the object streams and page contents of the document
+# on a pool of threads when it is opened.
+#
+# For a single very large file, PDFDocument.from_path("mydoc.pdf",
+# processes=8) decodes the content of its pages in 8 worker processes, which
+# each map the file themselves, before the structure tree is built.
+#
+# doc.save_snapshot("mydoc.snap") saves the tree and its text in a binary
+# file; load_snapshot("mydoc.snap") maps it again without the PDF, reading
+# nodes as they are used, and gives the same views as compact_tree().
+#
+# For keyword search over many documents, TextIndex().add_document(doc)
+# indexes the words of each piece of marked content with its structure path
+# (e.g. "Table 3 > TR 5 > TD 2"), page and MCID; index.search("net income",
+# role="Table") finds phrases, and indexes can be saved, loaded and merged.
+#
+# To see where the time goes, pass stats=True (or a Stats object, to add up
+# several documents or to register hooks for an external metrics system);
+# doc.stats then holds the time spent in each phase of parsing and counts of
+# the objects, bytes and text decoded, and print doc.stats.report() shows
+# them. Without it, doc.stats is None and nothing is recorded.
+#
+# To extract many files at once, extract_many(paths, workers=N) yields one
+# record (a dict with the path, and the structure and text or an error) per
+# file using a pool of processes. From the command line:
+# python -m pyPDFStructure -j 8 a.pdf b.pdf ... > out.ndjson
+# writes the records as newline-delimited JSON; give "-" to read the paths
+# from stdin, one per line. A file whose worker dies, or which takes longer
+# than -t seconds (default 600), gets an error record.
+#
 # Note this is only designed to work with Tagged PDFs, e.g those exported by
 # Word 2010 and later, which contain structual information for accessibility,
 # none of which is retained by other python pdf libraries, but which is crucial
@@ -33,8 +111,25 @@
 #    load contents object and store all MCs in global dict of MCs
 #  load structuretreeroot object and build document tree recursively
 
+import array
+import binascii
+import bisect
+import csv
+import hashlib
+import json
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import os
+import Queue
 import re
+import struct
+import sys
+import time
+import urllib2
+import warnings
 import zlib
+from collections import namedtuple, OrderedDict
 
 def print_dict(d, indent=""): # helper method to pretty-print dicts
 	for k in d:
@@ -49,133 +144,182 @@ def print_dict(d, indent=""): # helper method to pretty-print dicts
 		else:
 			print indent + k + ": " + str(v)
 
-def int_from_bytes(bs): # used to convert bytes in xrefstm to ints
-	bs = bytearray(bs)
-	bs.reverse()
-	res = 0
-	for x in range(len(bs)-1, -1, -1):
-		res += bs[x]
-		if x != 0:
-			res = res << 8
-	return res
-
-def get_reference(str):
-	parts = str.strip(" \n\r").split(" ") # str is like "123 0 R"
-	if len(parts)<3:
-		raise Exception("Tried to dereference non-reference: " + str)
-	return int(parts[0])
-
-def is_alpha(c):
-	o = ord(c)
-	return (o >= ord("A") and o <= ord("Z")) or (o >= ord("a") and
-		o <= ord("z")) or (o >= ord("0") and o <= ord("9"))
-
-def read_dict(str): # parse a dictionary including nested arrays and dicts
-	str = str.strip(" \n\r")
-	i=0
-	done = False
-	indict = False
-	inkey = False
-	invalue = False
-	waiting = "key"
-	currkeyname = ""
-	currvalue = ""
-	lastchar = ""
-	d = {}
-	while i < len(str) and not done:
-		c = str[i]
-		if indict: # if we are in a dictionary
-			
-			if not invalue and not inkey:
-				if waiting=="key" and c=="/":
-					inkey = True
-				elif waiting=="value" and c!=" ":
-					invalue = True
-			
-			if inkey: # if we are currently reading a key name
-				if is_alpha(c): # if we are still reading value key-name chars
-					currkeyname += c # append to the current key name
-				elif len(currkeyname)>0: # reached end of key
-					inkey = False
-					while str[i] in ['\n', '\r', ' ']:
-						i += 1
-					c = str[i]
-					if str[i:i+2]=="<<": # if value is a dict, read recursively
-						(d[currkeyname], offset) = read_dict(str[i:])
-						currkeyname = ""
-						currvalue = ""
-						waiting = "key" # get ready to read another key
-						i += (offset-1) # skip to the end of the dict
-					elif str[i]=="[": # if value is an array
-						(d[currkeyname], offset) = read_array(str[i:]) # read it
-						currkeyname = ""
-						currvalue = ""
-						waiting = "key" # get ready to read another key
-						i += (offset-1) # skip to the end of the array
-					elif c==" ":
-						waiting = "value"
-					else:
-						invalue = True
-			
-			if invalue: # if we are currently reading a value
-				if (c != "/" and c!=">") or len(currvalue)==0:
-					currvalue += c # most chars are ok
-				else:
-					if currkeyname != "": # if we actually read a key
-						d[currkeyname] = currvalue.strip(" \n\r") # store it
-					currkeyname = ""
-					currvalue = ""
-					invalue = False
-					inkey = True
-			
-			if c==">" and lastchar==">": # reached end of dict
-				done = True
-		else:
-			if c=="<" and lastchar=="<": # found start of dict
-				indict = True
-		lastchar = c
-		i += 1
-	return (d, i) # return the dict and number of chars consumed
+class PDFName(str): # a name object, stored with its leading slash e.g. "/Type"
+	pass
 
-def read_array(str): # TODO: method is hideous, need to write a proper parser
-	out = []
-	end = str.find("]")+1
-	str = str[:end]
-	refs = re.findall("\[*\s*(\d+\s+\d+\s+R)", str)
-	if len(refs)>0: # if it was an array of references
-		for ref in refs:
-			out.append(ref)
-	else:
-		vals = re.findall("\[*/([^/\]]+)", str)
-		if len(vals)>0: # if it was an array of strings
-			for val in vals:
-				out.append(val)
+class PDFString(str): # a literal string object, with its escapes decoded
+	pass
+
+class PDFHexString(PDFString): # a <hex> string object, stored as raw bytes
+	pass
+
+class PDFKeyword(str): # a bare keyword, e.g. a content stream operator
+	pass
+
+PDFRef = namedtuple("PDFRef", "num gen") # an indirect reference, e.g. 12 0 R
+
+def get_reference(ref):
+	if not isinstance(ref, PDFRef):
+		raise Exception("Tried to dereference non-reference: " + repr(ref))
+	return ref.num
+
+# All PDF object syntax is read by one scanner, which works directly on the
+# document buffer (a string or an mmap) from a start offset. Each regex match
+# skips any whitespace and comments and consumes exactly one token, so the only
+# substrings ever created are the tokens themselves.
+_ws = "[\\x00\\t\\n\\x0c\\r ]"
+_regular = "[^\\x00\\t\\n\\x0c\\r ()<>\\[\\]{}/%]"
+_token_re = re.compile(r"""
+	(?:%(ws)s|%%[^\r\n]*)*
+	(?:
+		(?P<ref>(?P<refnum>\d+)%(ws)s+(?P<refgen>\d+)%(ws)s+R(?!%(regular)s))
+		|(?P<num>[+-]?(?:\d+\.?\d*|\.\d+))
+		|(?P<name>/%(regular)s*)
+		|(?P<open><<|\[)
+		|(?P<close>>>|\])
+		|(?P<hex><[0-9A-Fa-f\x00\t\n\x0c\r ]*>)
+		|(?P<str>\()
+		|(?P<kw>%(regular)s+|[{}])
+	)""" % {"ws": _ws, "regular": _regular}, re.X)
+_xref_subsection_re = re.compile(r"%s*(\d+) +(\d+) *(?:\r\n|\r|\n)" % _ws)
+_ws_re = re.compile(r"(?:%s|%%[^\r\n]*)*" % _ws)
+_name_escape_re = re.compile(r"#([0-9A-Fa-f]{2})")
+_hex_junk_re = re.compile(_ws + "+")
+_string_special_re = re.compile(r"[()\\]")
+_string_escapes = {"n": "\n", "r": "\r", "t": "\t", "b": "\b", "f": "\f",
+	"(": "(", ")": ")", "\\": "\\"}
+_keyword_values = {"true": True, "false": False, "null": None}
+
+def skip_whitespace(buf, pos, end=None): # returns offset of the next token
+	if end is None:
+		end = len(buf)
+	return _ws_re.match(buf, pos, end).end()
+
+def decode_name(tok): # turn "/A#20B" into "/A B"
+	if "#" in tok:
+		tok = _name_escape_re.sub(lambda m: chr(int(m.group(1), 16)), tok)
+	return tok
+
+def read_literal_string(buf, pos, end):
+	# pos is just after the opening bracket. Strings may contain balanced
+	# brackets, and backslash escapes including octal codes and line breaks
+	parts = []
+	depth = 1
+	search = _string_special_re.search
+	while True:
+		m = search(buf, pos, end)
+		if m is None:
+			raise Exception("Unterminated string at offset " + str(pos))
+		i = m.start()
+		if i > pos:
+			parts.append(buf[pos:i])
+		c = buf[i]
+		pos = i+1
+		if c == "(":
+			depth += 1
+			parts.append(c)
+		elif c == ")":
+			depth -= 1
+			if depth == 0:
+				return PDFString("".join(parts)), pos
+			parts.append(c)
+		else: # backslash escape
+			c = buf[pos:pos+1]
+			pos += 1
+			if c in _string_escapes:
+				parts.append(_string_escapes[c])
+			elif "0" <= c <= "7": # up to three octal digits
+				digits = c
+				while len(digits) < 3 and pos < end and "0" <= buf[pos] <= "7":
+					digits += buf[pos]
+					pos += 1
+				parts.append(chr(int(digits, 8) & 0xFF))
+			elif c == "\r": # escaped line break is ignored
+				if buf[pos:pos+1] == "\n":
+					pos += 1
+			elif c != "\n":
+				parts.append(c) # unknown escape, the backslash is ignored
+
+def read_object(buf, pos=0, end=None):
+	# parse the object (of any type) starting at pos, returning the value and
+	# the offset just after it. Containers are built with an explicit stack, so
+	# deeply nested arrays and dicts cannot hit the recursion limit. Dicts are
+	# returned with their keys stripped of the leading slash, e.g. d["Type"]
+	if end is None:
+		end = len(buf)
+	match = _token_re.match
+	stack = [] # lists being built; dicts are collected as [k1, v1, k2, v2...]
+	kinds = [] # "[" or "<<" for each entry on the stack
+	while True:
+		m = match(buf, pos, end)
+		if m is None:
+			raise Exception("PDF syntax error at offset " + str(pos))
+		pos = m.end()
+		kind = m.lastgroup
+		if kind == "name":
+			tok = m.group(kind)
+			val = PDFName(tok if "#" not in tok else decode_name(tok))
+		elif kind == "num":
+			tok = m.group(kind)
+			val = float(tok) if "." in tok else int(tok)
+		elif kind == "ref":
+			(num, gen) = m.group("refnum", "refgen")
+			val = PDFRef(int(num), int(gen))
+		elif kind == "open":
+			stack.append([])
+			kinds.append(m.group(kind))
+			continue
+		elif kind == "close":
+			if not stack:
+				raise Exception("Unbalanced " + m.group(kind) + " at offset " +
+					str(m.start(kind)))
+			items = stack.pop()
+			if kinds.pop() == "<<":
+				val = {}
+				for i in range(0, len(items)-1, 2):
+					val[items[i][1:]] = items[i+1]
+			else:
+				val = items
+		elif kind == "hex":
+			digits = _hex_junk_re.sub("", m.group(kind)[1:-1])
+			if len(digits) % 2:
+				digits += "0" # a missing final digit is taken to be zero
+			val = PDFHexString(binascii.unhexlify(digits))
+		elif kind == "str":
+			(val, pos) = read_literal_string(buf, pos, end)
 		else:
-			hexs = re.findall("\[*(<\w+>)", str)
-			if len(hexs)>0: # if it was an array of hex values
-				for hex in hexs:
-					out.append(hex)
+			tok = m.group(kind)
+			if tok in _keyword_values:
+				val = _keyword_values[tok]
 			else:
-				vals = re.findall("\[*\W*(\d+?)\W", str)
-				if len(vals)>0: # if it was an array of ints
-					for val in vals:
-						out.append(int(val))
-	return (out, end) # return array and number of chars consumed
+				val = PDFKeyword(tok)
+		if not stack:
+			return (val, pos)
+		stack[-1].append(val)
 
-def do_load_object(doc, str, forcetype=None):
+def do_load_object(doc, buf, pos, end, forcetype=None):
 	# we have forcetype to allow reading of objects which do not declare a type,
 	# but we know what type they must be (eg content streams, info object)
-	(d, dict_end) = read_dict(str) # read the object dictionary
-	str = str[dict_end:].strip(" \n\r")
+	# the object spans buf[pos:end]; streams are read from the same buffer
+	(d, pos) = read_object(buf, pos, end) # read the object dictionary
+	return make_object(doc, d, buf, pos, end, forcetype)
+
+def make_object(doc, d, buf, pos, end, forcetype=None):
+	# construct the object for the dictionary d; any stream data follows the
+	# dictionary at buf[pos:end]
+	if not isinstance(d, dict):
+		raise Exception("Object is not a dictionary: " + repr(d))
 	if "Type" in d:
 		type = d["Type"]
 	else:
 		type = forcetype
+	if doc.stats is not None and type is not None:
+		doc.stats.count("objects:" + type[1:])
 	
 	if type != None:
 		o = None
 		if type=="/ObjStm": # Object Stream
-			o = ObjStm(doc, str, d)
+			o = ObjStm(doc, buf, pos, end, d)
 		elif type=="/Catalog": # Catalog
 			o = Catalog(doc, d)
 		elif type=="/Pages": # Pages object
@@ -183,19 +327,18 @@ def do_load_object(doc, str, forcetype=None):
 		elif type=="/Page": # Page object
 			o = Page(doc, d)
 		elif type=="/Font": # Font object
-			o = Font(doc, str, d)
+			o = Font(doc, d)
 		elif type=="/CMap": # Character Map object
-			o = CMap(doc, str, d)
+			o = CMap(doc, buf, pos, end, d)
 		elif type=="/StructTreeRoot": # Root of Structure Tree
 			o = StructTreeRoot(doc, d)
 		elif type=="/StructElem": # Element of Structure Tree
 			o = StructElem(doc, d)
 		elif type=="/ContentStm": # Page Contents (needs to be forced)
-			o = ContentStm(doc, str, d)
+			o = ContentStm(doc, buf, pos, end, d)
 		elif type=="/Info": # PDF Info dict (needs to be forced):
 			o = PDFInfo(d)
 		elif type=="/OBJR": # PDF Object (image etc. - should be safe to ignore)
-			print "OBJR found, ignoring"
 			o = None
 		else:
 			raise Exception("Unknown type: " + type)
@@ -203,138 +346,551 @@ def do_load_object(doc, str, forcetype=None):
 		raise Exception("Object does not declare a type, and none was forced.")
 	return o
 
+# the types which ObjStm.load_all() constructs: everything that can be loaded
+# from a dictionary in an object stream without knowing a forced type
+_batch_types = frozenset(["/Catalog", "/Pages", "/Page", "/Font",
+	"/StructTreeRoot", "/StructElem"])
+
+STREAM_CHUNK = 65536 # bytes of stream data read or inflated at a time
+
+def stream_extent(doc, buf, pos, end, d):
+	# (start, stop) of the raw data of the stream whose dictionary d ends at
+	# pos. The /Length is used if it is valid: it may be an indirect object,
+	# which is only looked up if a document is given. Otherwise the data is
+	# taken to end at the last "endstream" before end
+	start = buf.find("stream", pos, end)+6
+	if buf[start] == "\r": # the keyword is followed by CRLF or LF
+		start += 1
+	if buf[start] == "\n":
+		start += 1
+	length = d.get("Length")
+	if type(length) == PDFRef and doc is not None:
+		length = doc.get_value(get_reference(length))
+	if type(length) in (int, long) and 0 <= length <= len(buf) - start:
+		stop = start + length
+		after = skip_whitespace(buf, stop, min(stop+16, len(buf)))
+		if buf[after:after+9] == "endstream":
+			return (start, stop)
+	stop = buf.rfind("endstream", start, end)
+	if buf[stop-2:stop] == "\r\n":
+		stop -= 2
+	elif buf[stop-1:stop] in ("\r", "\n"):
+		stop -= 1
+	return (start, stop)
+
+def stream_filters(d): # the names of the filters of a stream, in order
+	filters = d.get("Filter")
+	if filters is None:
+		return []
+	if type(filters) != list:
+		return [filters]
+	return filters
+
+def iter_stream(buf, start, stop, filters, stats=None):
+	# yield the decoded data of buf[start:stop] in pieces of at most about
+	# STREAM_CHUNK bytes, so neither the raw nor the decoded stream needs to
+	# be copied whole. Inflating is recorded in stats, if given
+	if not filters:
+		for pos in range(start, stop, STREAM_CHUNK):
+			yield buf[pos:min(pos+STREAM_CHUNK, stop)]
+		return
+	if filters != ["/FlateDecode"]:
+		raise Exception("Unknown stream format: " + " ".join(filters))
+	inflater = zlib.decompressobj()
+	for pos in range(start, stop, STREAM_CHUNK):
+		data = buf[pos:min(pos+STREAM_CHUNK, stop)]
+		while data:
+			if stats is not None:
+				out = stats.call("inflate", inflater.decompress, data, STREAM_CHUNK)
+				stats.count("bytes_inflated", len(out))
+			else:
+				out = inflater.decompress(data, STREAM_CHUNK)
+			if out:
+				yield out
+			data = inflater.unconsumed_tail
+		if inflater.unused_data: # data after the end of the zlib stream
+			break
+	out = inflater.flush()
+	if out:
+		yield out
+
+def read_stream(buf, start, stop, filters, stats=None): # the whole decoded stream
+	return "".join(iter_stream(buf, start, stop, filters, stats))
+
+def inflate_or_none(stream): # read_stream(*stream), or None if it fails
+	try:
+		return read_stream(*stream)
+	except Exception:
+		return None
+
 class MarkedContent: # a marked piece of text (linked somewhere in structure)
-	def __init__(self, doc, str):
-		self.text = ""
-		lines = str.split("\n")
-		currfont = None
-		for line in lines:
-			line = line.strip(" \t\n\r")
-			if len(line)<2:
-				continue
-			if line[-2:]=="Tf":
-				currfont = doc.currentpage.fonts[line.split(" ")[0].strip("/")]
-			if line[-2:]=="TJ":
-				escape = False
-				inbracket = False
-				inunicode = False
-				unicodetmp = ""
-				for ch in line[:-2].strip(" []"):
-					if escape:
-						self.text += ch
-						escape = False
-					else:
-						if not inunicode:
-							if ch=="(":
-								inbracket = True
-								continue
-							elif ch==")":
-								inbracket = False
-								continue
-						if not inbracket:
-							if ch=="<":
-								inunicode = True
-								continue
-							elif ch==">":
-								inunicode = False
-								continue
-						if ch=="\\":
-							escape=True
-						else:
-							if inbracket:
-								self.text += ch
-							elif inunicode:
-								unicodetmp += ch
-							if len(unicodetmp)==4:
-								self.text += unichr(currfont.tounicode.map_char(int(unicodetmp, 16)))
-								unicodetmp = ""
+	def __init__(self, mcid, text):
+		self.mcid = mcid
+		self.text = text
+
+class lazy_attribute(object):
+	# decorator for an attribute which is resolved on first access, then stored
+	# on the instance so later reads are plain attribute lookups. Deleting the
+	# stored value makes the next access resolve it again
+	def __init__(self, fget):
+		self.fget = fget
+		self.__name__ = fget.__name__
+	
+	def __get__(self, obj, cls):
+		if obj is None:
+			return self
+		val = self.fget(obj)
+		# objects of a document with a bounded cache must not hold on to each
+		# other, or evicting them would not free anything; they look up the
+		# document's cache each time instead
+		doc = getattr(obj, "doc", None)
+		if doc is None or not doc.objects.bounded:
+			obj.__dict__[self.__name__] = val
+		return val
+
+def lazy_attributes(cls): # the names of the lazy_attributes of a class and its bases
+	names = [name for (name, val) in vars(cls).items() if isinstance(val, lazy_attribute)]
+	for base in cls.__bases__:
+		names += lazy_attributes(base)
+	return names
+
+def code_from_bytes(s): # turn a string of bytes into a big-endian character code
+	code = 0
+	for c in s:
+		code = (code << 8) | ord(c)
+	return code
+
+def shift_text(text, n): # the text mapped to n codes after the one giving text
+	if n == 0:
+		return text
+	return text[:-1] + unichr(ord(text[-1]) + n)
+
+def cmap_text(dst): # the unicode text of a CMap destination, or None if it has none
+	# destinations are UTF-16BE, but some CMaps give an odd number of bytes,
+	# e.g. <41>, which are taken as one big-endian code point
+	if not isinstance(dst, PDFString) or not dst:
+		return None
+	try:
+		if len(dst) % 2:
+			return unichr(code_from_bytes(dst))
+		return dst.decode("utf-16-be")
+	except (UnicodeDecodeError, ValueError):
+		return None
+
+class LRUCache: # a dict which can be bounded, dropping least recently used keys
+	# entries are bounded by count (max_items) and/or by the total of the sizes
+	# given to put (max_bytes); with neither it is a plain unbounded dict
+	def __init__(self, max_items=None, max_bytes=None):
+		self.max_items = max_items
+		self.max_bytes = max_bytes
+		self.bounded = max_items is not None or max_bytes is not None
+		self.entries = OrderedDict() if self.bounded else {}
+		self.sizes = {}
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def get(self, key, default=None):
+		try:
+			val = self.entries[key]
+		except KeyError:
+			self.misses += 1
+			return default
+		self.hits += 1
+		if self.bounded: # move to the most recently used end
+			del self.entries[key]
+			self.entries[key] = val
+		return val
+	
+	def put(self, key, val, size=0):
+		self.pop(key)
+		self.entries[key] = val
+		self.sizes[key] = size
+		self.bytes += size
+		if self.bounded:
+			# evict the oldest entries, but always keep the one just added
+			while len(self.entries) > 1 and (
+					(self.max_items is not None and len(self.entries) > self.max_items) or
+					(self.max_bytes is not None and self.bytes > self.max_bytes)):
+				(key, _) = self.entries.popitem(last=False)
+				self.bytes -= self.sizes.pop(key)
+				self.evictions += 1
+	
+	def resize(self, key, size):
+		# change the size of an entry, e.g. as the data it holds grows, making
+		# it the most recently used and evicting others if needed
+		if key in self.entries:
+			self.put(key, self.entries[key], size)
+	
+	def pop(self, key, default=None):
+		if key not in self.entries:
+			return default
+		self.bytes -= self.sizes.pop(key)
+		return self.entries.pop(key)
+	
+	def clear(self):
+		self.entries.clear()
+		self.sizes.clear()
+		self.bytes = 0
+	
+	def __contains__(self, key):
+		return key in self.entries
+	
+	def __len__(self):
+		return len(self.entries)
+	
+	def values(self):
+		return self.entries.values()
+
+class Stats: # time spent in each phase of parsing, and counts of the work done
+	# Phases nest, and the time of a phase does not include the phases
+	# started within it, so the times add up to the total. They are "xref"
+	# (reading the cross-reference data), "parse" (reading and constructing
+	# objects), "inflate", "cmap" (compiling ToUnicode CMaps) and "content"
+	# (scanning content streams and decoding their text). Counts are
+	# "objects:<Type>" for each object constructed, "cache_hits" and
+	# "cache_misses" of PDFDocument.get_object, "bytes_inflated", "mcids"
+	# (pieces of marked content decoded), "cmap_lookups" (strings decoded
+	# through a CMap) and "cmaps_shared" (CMaps found in cmap_cache). Each
+	# hook is called as hook("time", phase, seconds) or hook("count", name, n)
+	# whenever one is recorded
+	def __init__(self, hooks=()):
+		self.times = {} # phase -> seconds
+		self.counts = {} # name -> count
+		self.hooks = list(hooks)
+		self.phases = [] # the phases in progress, innermost last
+		self.last = None # when time was last added to the innermost phase
+	
+	def add_hook(self, hook):
+		self.hooks.append(hook)
+	
+	def count(self, name, n=1):
+		self.counts[name] = self.counts.get(name, 0) + n
+		for hook in self.hooks:
+			hook("count", name, n)
+	
+	def add_time(self, phase, seconds):
+		self.times[phase] = self.times.get(phase, 0.0) + seconds
+		for hook in self.hooks:
+			hook("time", phase, seconds)
+	
+	def start(self, phase): # every start must be followed by a stop
+		now = time.time()
+		if self.phases: # the enclosing phase is paused
+			self.add_time(self.phases[-1], now - self.last)
+		self.phases.append(phase)
+		self.last = now
+	
+	def stop(self):
+		now = time.time()
+		self.add_time(self.phases.pop(), now - self.last)
+		self.last = now
+	
+	def call(self, phase, fn, *args): # fn(*args), timed as the given phase
+		self.start(phase)
+		try:
+			return fn(*args)
+		finally:
+			self.stop()
+	
+	def reset(self):
+		self.times.clear()
+		self.counts.clear()
+	
+	def report(self): # the times and counts as text, one per line
+		lines = ["%-24s %10.4fs" % (phase, self.times[phase])
+			for phase in sorted(self.times, key=self.times.get, reverse=True)]
+		lines += ["%-24s %10d" % (name, self.counts[name]) for name in sorted(self.counts)]
+		return "\n".join(lines)
+
+CacheInfo = namedtuple("CacheInfo", "hits misses evictions objects bytes")
+OBJECT_CACHE_OVERHEAD = 500 # rough size of a parsed object, for cache_bytes
+_missing = object()
+
+# compiled ToUnicode maps, shared by all documents and keyed by stream contents
+cmap_cache = LRUCache(max_items=256)
+DENSE_CMAP_CODES = 0x1000 # CMaps with codes below this use a direct lookup table
 
 class PDFObj: # parent class for all PDF objects
+	cachesize = 0 # bytes of decoded stream data held, for the object cache
+	num = None # the object number (its key in the cache), set by PDFDocument.get_object
+	
 	def __init__(self, doc, type):
 		self.doc = doc
 		self.type = type
+	
+	def set_cachesize(self, size): # change cachesize, and the object cache's charge for it
+		self.cachesize = size
+		if self.num is not None and self.doc is not None and \
+				self.doc.objects.entries.get(self.num) is self:
+			self.doc.objects.resize(self.num, OBJECT_CACHE_OVERHEAD + size)
+	
+	def rebind(self, doc, oldbuf):
+		# move the object to doc, a later revision of its document whose file
+		# starts with the bytes of oldbuf (see PDFDocument.reopen_updated).
+		# Attributes resolved from the old document are dropped, so they are
+		# resolved again in the new one
+		self.doc = doc
+		for name in lazy_attributes(self.__class__):
+			self.__dict__.pop(name, None)
 
 class Catalog(PDFObj): # the root of the document, contains pages and structure
 	def __init__(self, doc, d):
 		PDFObj.__init__(self, doc, "Catalog")
-		self.pages = doc.get_object(get_reference(d["Pages"]))
-		if "StructTreeRoot" in d:
-			self.structtreeroot = doc.get_object(get_reference(d["StructTreeRoot"]))
+		self.pagesref = d["Pages"]
+		self.structtreerootref = d.get("StructTreeRoot")
+	
+	@lazy_attribute
+	def pages(self):
+		return self.doc.get_object(get_reference(self.pagesref))
+	
+	@lazy_attribute
+	def structtreeroot(self): # None if the document is not tagged
+		if self.structtreerootref is None:
+			return None
+		return self.doc.get_object(get_reference(self.structtreerootref))
 
 class Pages(PDFObj): # the 'pages' object, containing a list of all pages
 	def __init__(self, doc, d):
 		PDFObj.__init__(self, doc, "Pages")
-		self.count = int(d["Count"])
-		self.pages = []
-		for pageref in d["Kids"]:
-			self.pages.append(doc.get_object(get_reference(pageref)))
+		self.count = d["Count"]
+		self.kidrefs = d["Kids"]
+	
+	@lazy_attribute
+	def pages(self):
+		# kids may themselves be Pages nodes; flatten them in document order
+		pages = []
+		todo = list(reversed(self.kidrefs))
+		while todo:
+			kid = self.doc.get_object(get_reference(todo.pop()))
+			if isinstance(kid, Pages):
+				todo.extend(reversed(kid.kidrefs))
+			else:
+				pages.append(kid)
+		return pages
 
 class Page(PDFObj): # a single page, contains the content stream with text etc.
 	def __init__(self, doc, d):
 		PDFObj.__init__(self, doc, "Page")
-		fontrefs = d["Resources"]["Font"]
-		self.fonts = {}
-		for k in fontrefs:
-			self.fonts[k] = doc.get_object(get_reference(fontrefs[k]))
-		doc.currentpage = self # store the current page so font lookups can be made
-		self.contents = doc.get_object(
-			get_reference(d["Contents"]), "/ContentStm" )
+		self.fontrefs = d["Resources"].get("Font", {})
+		self.contentsref = d["Contents"] # a stream, or an array of streams
+		self.structparents = d.get("StructParents") # key in the ParentTree
+		if type(self.contentsref) == list: # cached by the list of references
+			self.contentskey = tuple(get_reference(ref) for ref in self.contentsref)
+		else:
+			self.contentskey = get_reference(self.contentsref)
+	
+	@lazy_attribute
+	def fonts(self):
+		fonts = {}
+		for k in self.fontrefs:
+			fonts[k] = self.doc.get_object(get_reference(self.fontrefs[k]))
+		return fonts
+	
+	@lazy_attribute
+	def contents(self):
+		if type(self.contentskey) != tuple:
+			return self.doc.get_object(self.contentskey, "/ContentStm")
+		# the streams are read as one, in order
+		contents = self.doc.objects.get(self.contentskey)
+		if contents is None:
+			contents = ContentStm.join(self.doc, [self.doc.get_object(ref,
+				"/ContentStm") for ref in self.contentskey])
+			contents.num = self.contentskey # its key in the cache
+			self.doc.objects.put(self.contentskey, contents, OBJECT_CACHE_OVERHEAD)
+		return contents
+	
+	def read_contents(self, mcid=None):
+		# the content stream, with its marked content read. With an mcid, the
+		# stream is only read as far as the end of that marked content
+		contents = self.contents
+		if not contents.finished and (mcid is None or mcid not in contents.mcs):
+			contents.read_page(self.fonts, mcid) # decoded with this page's fonts
+		return contents
+	
+	def get_mc(self, id): # the marked content with the given MCID
+		mcs = self.doc.decoded_pages.get(self.num)
+		if mcs is not None: # decoded in advance, see PDFDocument.decode_pages
+			if int(id) not in mcs:
+				raise Exception("Cannot find MCID " + str(id))
+			return mcs[int(id)]
+		return self.read_contents(int(id)).get_mc(id)
+	
+	def release_contents(self):
+		# drop the decoded content stream; it is decoded again if needed later
+		if "contents" in self.__dict__:
+			del self.__dict__["contents"]
+		self.doc.objects.pop(self.contentskey, None)
+		self.doc.decoded_pages.pop(self.num, None)
+
+class PageReleaser: # drops the decoded content of pages a walk has moved past
+	# visit is given the page of each piece of content the walk reaches; when
+	# the page changes, the previous one's content is released, and close
+	# releases the last
+	def __init__(self):
+		self.page = None
+	
+	def visit(self, page):
+		if page is not self.page:
+			self.close()
+			self.page = page
+	
+	def close(self):
+		if self.page is not None:
+			self.page.release_contents()
+			self.page = None
 
 class Font(PDFObj): # a font object
-	def __init__(self, doc, str, d):
+	def __init__(self, doc, d):
 		PDFObj.__init__(self, doc, "Font")
-		try:
-			self.tounicode = doc.get_object(get_reference(d["ToUnicode"]), "/CMap")
-		except KeyError:
-			pass
+		self.tounicoderef = d.get("ToUnicode")
+	
+	@lazy_attribute
+	def tounicode(self): # None if the font has no ToUnicode map
+		if self.tounicoderef is None:
+			return None
+		return self.doc.get_object(get_reference(self.tounicoderef), "/CMap")
 
 class CMap(PDFObj): # a character map object
-	def read_charcode(self, line, start):
-		start = line.find("<", start)+1
-		end = line.find(">", start)
-		return int(line[start:end], 16), end
+	# The parsed mappings are kept in a CMapIndex, shared through cmap_cache
+	# between every CMap whose stream data is identical, in any document
+	def map_char(self, charcode): # returns the unicode code point, or None
+		return self.index.map_char(charcode)
 	
-	def map_char(self, charcode):
-		for mapping in self.mappings:
-			if mapping[0] <= charcode and mapping[1] >= charcode:
-				return mapping[2] + (charcode - mapping[0])
+	def map_string(self, charcode): # returns the unicode text, or None
+		return self.index.map_string(charcode)
 	
-	def __init__(self, doc, str, d):
+	def decode(self, data): # decode a string of character codes
+		return self.index.decode(data)
+	
+	def __init__(self, doc, buf, pos, end, d):
 		PDFObj.__init__(self, doc, "CMap")
-		startstream = str.find("stream")+6
-		endstream = str.rfind("endstream")
-		# we need to remove the newlines:
-		# if using UNIX newlines, remove 1 char, else remove 2 (Windows newlines)
-		startstream += 2 if str[startstream] == '\r' else 1
-		endstream -= 2 if str[endstream-1] == '\r' else 1
-		stmdata = str[startstream:endstream]
-		if d["Filter"]=="/FlateDecode": # if the filter is zlib/decompress
-			dec = zlib.decompress(stmdata) # then decode the stream data
+		(start, stop) = stream_extent(doc, buf, pos, end, d)
+		filters = stream_filters(d)
+		key = (tuple(filters), hashlib.sha1(buf[start:stop]).digest())
+		self.index = cmap_cache.get(key)
+		if self.index is not None: # seen before, no need to decode it again
+			if doc.stats is not None:
+				doc.stats.count("cmaps_shared")
+			return
+		data = read_stream(buf, start, stop, filters, doc.stats)
+		if doc.stats is not None:
+			self.index = doc.stats.call("cmap", CMapIndex, data)
 		else:
-			raise Exception("Unknown stream format: " + d["Filter"])
-		self.mappings = []
-		reading_char = False
-		reading_range = False
-		for line in dec.split("\n"):
-			line = line.strip(" \r\n")
-			if line[-11:] == "beginbfchar":
-				reading_char = True
-			elif line[-9:] == "endbfchar":
-				reading_char = False
-			elif line[-12:] == "beginbfrange":
-				reading_range = True
-			elif line[-10:] == "endbfrange":
-				reading_range = False
+			self.index = CMapIndex(data)
+		cmap_cache.put(key, self.index)
+
+class CMapIndex: # the compiled mappings of a ToUnicode CMap
+	def map_char(self, charcode): # returns the unicode code point, or None
+		text = self.map_string(charcode)
+		if text is None:
+			return None
+		if len(text) == 2 and u"\ud800" <= text[0] < u"\udc00": # surrogate pair
+			return 0x10000 + ((ord(text[0]) - 0xd800) << 10) + ord(text[1]) - 0xdc00
+		return ord(text[0])
+	
+	def map_string(self, charcode): # returns the unicode text, or None
+		if self.table is not None:
+			if charcode < len(self.table):
+				return self.table[charcode]
+			return None
+		i = bisect.bisect_right(self.starts, charcode) - 1
+		if i < 0 or charcode > self.ends[i]:
+			return None
+		return shift_text(self.dsts[i], charcode - self.starts[i])
+	
+	def split_codes(self, data): # split a string into its character codes
+		if self.codewidth == 2:
+			n = len(data) // 2
+			return struct.unpack(">%dH" % n, data[:2*n])
+		if self.codewidth == 1:
+			return bytearray(data)
+		# mixed widths: each code is as long as the first codespace it fits
+		codes = []
+		i = 0
+		while i < len(data):
+			for (width, first, last) in self.codespaces:
+				code = code_from_bytes(data[i:i+width])
+				if first <= code <= last:
+					break
 			else:
-				if reading_char:
-					src, adv = self.read_charcode(line, 0)
-					dst, _ = self.read_charcode(line, adv)
-					self.mappings.append([src, src, dst])
-				elif reading_range:
-					base, e1 = self.read_charcode(line, 0)
-					end, e2 = self.read_charcode(line, e1)
-					dst, _ = self.read_charcode(line, e2)
-					self.mappings.append([base, end, dst])
+				width = 1
+				code = ord(data[i])
+			codes.append(code)
+			i += width
+		return codes
+	
+	def decode(self, data): # decode a string of character codes to unicode text
+		codes = self.split_codes(data)
+		if self.table is not None:
+			try:
+				return u"".join([self.table[c] for c in codes])
+			except (IndexError, TypeError): # some codes are not mapped
+				pass
+		return u"".join([self.map_string(c) or u"\ufffd" for c in codes])
+	
+	def __init__(self, dec):
+		# the stream is PostScript-like, so it is read with the object parser:
+		# operands are collected until the keyword which ends each section
+		self.codespaces = [] # (number of bytes, first code, last code)
+		mappings = [] # (first code, last code, unicode text of first code)
+		operands = []
+		pos = 0
+		end = len(dec)
+		while True:
+			pos = skip_whitespace(dec, pos, end)
+			if pos >= end:
+				break
+			(tok, pos) = read_object(dec, pos, end)
+			if type(tok) != PDFKeyword:
+				operands.append(tok)
+				continue
+			if tok == "endcodespacerange":
+				for i in range(0, len(operands)-1, 2):
+					self.codespaces.append((len(operands[i]),
+						code_from_bytes(operands[i]), code_from_bytes(operands[i+1])))
+			elif tok == "endbfchar": # entries which cannot be read are left out
+				for i in range(0, len(operands)-1, 2):
+					code = code_from_bytes(operands[i])
+					text = cmap_text(operands[i+1])
+					if text is not None:
+						mappings.append((code, code, text))
+			elif tok == "endbfrange":
+				for i in range(0, len(operands)-2, 3):
+					first = code_from_bytes(operands[i])
+					last = code_from_bytes(operands[i+1])
+					dst = operands[i+2]
+					if type(dst) == list: # one destination per code
+						for (code, text) in zip(range(first, last+1), dst):
+							text = cmap_text(text)
+							if text is not None:
+								mappings.append((code, code, text))
+					elif cmap_text(dst) is not None:
+						mappings.append((first, last, cmap_text(dst)))
+			operands = []
+		widths = set(cs[0] for cs in self.codespaces)
+		if len(widths) == 1:
+			self.codewidth = widths.pop()
+		elif widths:
+			self.codewidth = None # variable width, see split_codes
+			self.codespaces.sort()
+		else:
+			self.codewidth = 2 # no codespace given, assume two-byte codes
+		mappings.sort()
+		maxcode = mappings[-1][1] if mappings else -1
+		count = sum(m[1]-m[0]+1 for m in mappings)
+		if maxcode < DENSE_CMAP_CODES or (maxcode < 0x10000 and count*4 > maxcode):
+			# small or well-filled code space: index the text of each code directly
+			self.table = [None] * (maxcode+1)
+			for (first, last, text) in mappings:
+				for code in range(first, last+1):
+					self.table[code] = shift_text(text, code - first)
+		else: # sorted intervals, searched with bisect
+			self.table = None
+			self.starts = array.array("L", [m[0] for m in mappings])
+			self.ends = array.array("L", [m[1] for m in mappings])
+			self.dsts = [m[2] for m in mappings]
 
 class ContentStm(PDFObj): # a content stream, with rendering command / text
 	def get_mc(self, id):
@@ -342,243 +898,2456 @@ class ContentStm(PDFObj): # a content stream, with rendering command / text
 		if id in self.mcs:
 			return self.mcs[id]
 		else:
-			print self.mcs
 			raise Exception("Cannot find MCID " + str(id))
 	
-	def __init__(self, doc, str, d):
+	def __init__(self, doc, buf, pos, end, d, parts=None):
+		# given parts, a list of ContentStm, the content is read from each of
+		# them in turn instead (see join)
 		PDFObj.__init__(self, doc, "ContentStm")
-		startstream = str.find("stream")+6
-		endstream = str.rfind("endstream")
-		# we need to remove the newlines:
-		# if using UNIX newlines, remove 1 char, else remove 2 (Windows newlines)
-		startstream += 2 if str[startstream] == '\r' else 1
-		endstream -= 2 if str[endstream-1] == '\r' else 1
-		stmdata = str[startstream:endstream]
-		if d["Filter"]=="/FlateDecode": # if the filter is zlib/decompress
-			dec = zlib.decompress(stmdata) # then decode the stream data
+		if parts is not None:
+			self.streams = [stream for part in parts for stream in part.streams]
 		else:
-			raise Exception("Unknown stream format: " + d["Filter"])
+			(start, stop) = stream_extent(doc, buf, pos, end, d)
+			filters = stream_filters(d)
+			if filters and filters != ["/FlateDecode"]:
+				raise Exception("Unknown stream format: " + " ".join(filters))
+			self.streams = [(buf, start, stop, filters)]
+		# the streams are inflated and read a piece at a time by read_page,
+		# which is given the fonts of the page using them
 		self.mcs = {} # keep a dict of all marked content
-		offset = 0
+		self.scanner = None
+		self.finished = False
+		# charged for the text as it is decoded, and for raw data copied
+		# out of a SourceBuffer
+		self.cachesize = sum(stop - start for (buf, start, stop, filters)
+			in self.streams if isinstance(buf, SourceWindow))
+	
+	def rebind(self, doc, oldbuf):
+		PDFObj.rebind(self, doc, oldbuf)
+		self.streams = [(doc.pdfdoc if buf is oldbuf else buf, start, stop, filters)
+			for (buf, start, stop, filters) in self.streams]
+		if not self.finished: # the scan was reading the old buffer: start again
+			self.scanner = None
+			self.set_cachesize(self.cachesize - sum(len(mc.text) for mc in self.mcs.values()))
+			self.mcs = {}
+	
+	@classmethod
+	def join(cls, doc, parts): # one content stream read from several in turn
+		return cls(doc, None, 0, 0, None, parts)
+	
+	def read_page(self, fonts, mcid=None):
+		# collect the marked content of the stream, until the content with
+		# the given MCID is complete, or to the end. Reading resumes from
+		# where it stopped on the next call
+		if self.doc.stats is not None:
+			self.doc.stats.call("content", self.scan, fonts, mcid)
+		else:
+			self.scan(fonts, mcid)
+	
+	def scan(self, fonts, mcid):
+		if self.scanner is None:
+			self.scanner = self.read_operators(self.iter_data(), fonts)
+		for found in self.scanner:
+			if found == mcid:
+				return
+		self.scanner = None # nothing left to read
+		self.finished = True
+	
+	def iter_data(self): # the decoded data of the streams, in pieces
+		for (i, (buf, start, stop, filters)) in enumerate(self.streams):
+			if i:
+				yield "\n" # the streams are separated by whitespace
+			# see PDFDocument.inflate_streams
+			data = self.doc.inflated.pop(file_offset(buf, start), None)
+			if data is not None:
+				yield data
+				continue
+			for data in iter_stream(buf, start, stop, filters, self.doc.stats):
+				yield data
+	
+	def read_operators(self, chunks, fonts):
+		# one pass over the operators of the stream, tracking the nesting of
+		# marked content (BDC/BMC ... EMC) and the current font, and collecting
+		# the text shown inside each marked content sequence with an MCID.
+		# Text in nested marked content without an MCID belongs to the nearest
+		# enclosing sequence which has one. This is a generator which yields
+		# each MCID when its content is complete.
+		# The data arrives in pieces: when an operand or operator may run on
+		# into the next piece, the operands since the last operator are read
+		# again once more data has been added
+		match = _token_re.match
+		data = ""
+		more = True # whether chunks has any data left
+		pos = 0
+		opstart = 0 # where the operands of the next operator start
+		operands = []
+		stack = [] # (mcid, text parts) for each open marked content sequence
+		parts = None # text parts of the innermost sequence with an MCID
+		font = None
+		stats = self.doc.stats
 		while True:
-			start = dec.find("<</MCID", offset) # find marked content
-			if start<0:
-				break
-			next = dec.find("<</MCID ", start+10)
-			end_of_dict = dec.find(">>", start)
-			end = dec.rfind("EMC", start, next)
-			
-			(d, _) = read_dict(dec[start:end_of_dict+2]) # read the MC dict
-			id = int(d["MCID"]) # get the id
-			
-			self.mcs[id] = MarkedContent(doc, dec[start:end]) # store in our dict
-			offset = end # skip to the end of this MC
+			end = len(data)
+			m = match(data, pos, end)
+			try:
+				if m is None or (more and m.end() == end):
+					raise EOFError # a token may be incomplete
+				kind = m.lastgroup
+				pos = m.end()
+				if kind != "kw": # an operand
+					if kind == "str":
+						(val, pos) = read_literal_string(data, pos, end)
+					elif kind == "open": # arrays and dicts are read in one go
+						(val, pos) = read_object(data, m.start(kind), end)
+					elif kind == "hex":
+						digits = _hex_junk_re.sub("", m.group(kind)[1:-1])
+						if len(digits) % 2:
+							digits += "0"
+						val = binascii.unhexlify(digits)
+					else: # numbers and names are only needed as their text
+						val = m.group(kind)
+					operands.append(val)
+					continue
+				op = m.group(kind)
+				if op == "ID": # inline image data, skip to the end of it
+					m = _inline_image_end_re.search(data, pos+1, end)
+					if m is None and more:
+						raise EOFError
+					pos = m.end() if m is not None else end
+			except Exception:
+				if not more:
+					pos = skip_whitespace(data, pos, end)
+					if m is None and pos >= end:
+						break # the end of the stream
+					raise Exception("Content stream syntax error at offset " + str(pos))
+				# keep the unread data, and add at least as much again
+				data = [data[opstart:]]
+				size = len(data[0])
+				for chunk in chunks:
+					data.append(chunk)
+					size += len(chunk)
+					if size >= 2*len(data[0]):
+						break
+				else:
+					more = False
+				data = "".join(data)
+				pos = opstart = 0
+				del operands[:]
+				continue
+			if parts is not None and op in _show_text_ops and operands:
+				val = operands[-1] # the string, or array for TJ
+				if op == "TJ":
+					strings = [s for s in val if isinstance(s, str)]
+					if strings:
+						parts.append(decode_text(font, "".join(strings), stats))
+				elif isinstance(val, str):
+					parts.append(decode_text(font, val, stats))
+			elif op == "Tf":
+				if operands:
+					font = fonts.get(operands[0][1:])
+			elif op == "BDC" or op == "BMC":
+				props = operands[-1] if op == "BDC" and operands else None
+				if type(props) == dict and "MCID" in props:
+					parts = []
+					stack.append((props["MCID"], parts))
+				else:
+					stack.append((None, parts))
+			elif op == "EMC":
+				if stack:
+					(mcid, mcparts) = stack.pop()
+					if mcid is not None:
+						self.add_mc(mcid, u"".join(mcparts))
+						if stats is not None:
+							stats.count("mcids")
+						parts = stack[-1][1] if stack else None
+						opstart = pos
+						del operands[:]
+						yield mcid
+						continue
+			opstart = pos
+			del operands[:]
+	
+	def add_mc(self, mcid, text):
+		self.set_cachesize(self.cachesize + len(text))
+		if mcid in self.mcs: # sequences sharing an MCID form one piece of content
+			text = self.mcs[mcid].text + text
+		self.mcs[mcid] = MarkedContent(mcid, text)
+
+_show_text_ops = frozenset(["Tj", "TJ", "'", '"'])
+_inline_image_end_re = re.compile(r"%sEI(?=%s|$)" % (_ws, _ws))
+
+def decode_text(font, data, stats=None): # decode a string shown using the given font
+	if font is None or font.tounicode is None:
+		return data.decode("latin-1")
+	if stats is not None:
+		stats.count("cmap_lookups")
+	return font.tounicode.decode(data)
+
+def kid_list(kids): # the entries of a /K, as a list without any nulls
+	if type(kids) != list: # a single kid need not be wrapped in an array
+		kids = [kids]
+	return [kid for kid in kids if kid is not None]
 
 class StructTreeRoot(PDFObj): # the root of the structure tree
 	def __init__(self, doc, d):
 		PDFObj.__init__(self, doc, "StructTreeRoot")
-		self.kids = []
-		for ref in d["K"]:
-			self.kids.append(doc.get_object(get_reference(ref)))
+		self.kidrefs = kid_list(d["K"])
+		self.parenttreeref = d.get("ParentTree") # None if there is none
+		self.rolemapref = d.get("RoleMap")
+	
+	@lazy_attribute
+	def kids(self):
+		kids = []
+		for ref in self.kidrefs:
+			kids.append(self.doc.get_object(get_reference(ref)))
+		return kids
 
 class StructElem(PDFObj): # an element in the structure tree, may be one of many
 	# subtypes, such as P (paragraph), Sect (document section) etc.
 	def __init__(self, doc, d):
 		PDFObj.__init__(self, doc, "StructElem")
 		self.subtype = d["S"]
-		self.kids = []
-		
-		if "Pg" in d:
-			self.page = doc.get_object(get_reference(d["Pg"]))
-		
-		if type(d["K"])!=list: # hotfix for times when K is present as a string
-			d["K"] = [int(d["K"])]
-		
-		for ref in d["K"]:
-			if type(ref)==str:
-				self.kids.append(doc.get_object(get_reference(ref)))
+		self.parentref = d.get("P")
+		self.pageref = d.get("Pg")
+		self.kidrefs = kid_list(d.get("K", []))
+		self.attrs = d.get("A") # attribute objects, if any
+	
+	def get_attribute(self, name, owner=None):
+		# the value of an attribute such as "RowSpan" from /A, or None. The
+		# attribute objects may be given with revision numbers, or indirectly;
+		# with an owner, e.g. "/Table", only its attribute objects are used
+		attrs = self.attrs
+		if type(attrs) != list:
+			attrs = [attrs]
+		for attr in attrs:
+			if type(attr) == PDFRef:
+				attr = self.doc.get_value(get_reference(attr))
+			if type(attr) != dict or name not in attr:
+				continue
+			if owner is None or attr.get("O") == owner:
+				return attr[name]
+		return None
+	
+	@lazy_attribute
+	def page(self): # None if no page is given for this element
+		if self.pageref is None:
+			return None
+		return self.doc.get_object(get_reference(self.pageref))
+	
+	@lazy_attribute
+	def role(self): # the standard structure type, after the RoleMap, e.g. "H1"
+		return self.doc.map_role(self.subtype)
+	
+	@lazy_attribute
+	def parent(self): # the parent element, or None at the top of the tree
+		if type(self.parentref) == PDFRef:
+			parent = self.doc.get_object(get_reference(self.parentref))
+			return parent if isinstance(parent, StructElem) else None
+		index = self.doc.structure_index # no /P, so use where it was found
+		pos = index.positions.get(self.num)
+		if pos is None or index.parents[pos] < 0:
+			return None
+		return self.doc.get_object(index.nums[index.parents[pos]])
+	
+	@lazy_attribute
+	def depth(self): # 0 for a top-level element
+		return self.doc.structure_index.depth(self.num)
+	
+	def ancestors(self): # the parent, its parent and so on up to the top
+		elem = self.parent
+		while elem is not None:
+			yield elem
+			elem = elem.parent
+	
+	@lazy_attribute
+	def kids(self):
+		return [self.get_kid(ref) for ref in self.kidrefs]
+	
+	def get_kid(self, ref): # resolve one entry of kidrefs
+		if type(ref)==PDFRef: # another structure element
+			return self.doc.get_object(get_reference(ref))
+		if type(ref)==dict: # marked-content or object reference dict
+			if ref.get("Type")=="/OBJR":
+				return None # image etc. - safe to ignore
+			return self.get_kid_page(ref).get_mc(ref["MCID"])
+		return self.page.get_mc(ref) # an MCID on this element's page
+	
+	def get_kid_page(self, ref): # the page holding a marked-content kid
+		if type(ref)==dict and "Pg" in ref: # the content may be on another page
+			return self.doc.get_object(get_reference(ref["Pg"]))
+		return self.page
+	
+	def get_kid_pageref(self, ref): # the same, as a reference (or None)
+		if type(ref)==dict and "Pg" in ref:
+			return ref["Pg"]
+		return self.pageref
+
+class StructureIndex: # the role, parent and depth of every structure element
+	# built in one pass over the elements' dictionaries, without loading the
+	# elements, their pages or content. Elements are numbered by position in
+	# document order
+	def __init__(self, doc, root):
+		self.nums = array.array("L") # the object number of each element
+		self.parents = array.array("l") # the position of its parent, or -1
+		self.depths = array.array("L")
+		self.roles = [] # the role of each element, after the RoleMap
+		self.positions = {} # object number -> position
+		self.by_role = {} # role -> positions of the elements with that role
+		stack = [(-1, iter(root.kidrefs))]
+		while stack:
+			(parent, kidrefs) = stack[-1]
+			ref = next(kidrefs, _missing)
+			if ref is _missing: # finished with this element
+				stack.pop()
+				continue
+			if type(ref) != PDFRef: # marked content
+				continue
+			num = get_reference(ref)
+			if num in self.positions: # already indexed: the tree is malformed
+				continue
+			d = doc.get_value(num)
+			if type(d) != dict or "S" not in d: # an object or content reference
+				continue
+			pos = len(self.nums)
+			role = doc.map_role(d["S"])
+			self.positions[num] = pos
+			self.nums.append(num)
+			self.parents.append(parent)
+			self.depths.append(len(stack)-1)
+			self.roles.append(role)
+			self.by_role.setdefault(role, []).append(pos)
+			stack.append((pos, iter(kid_list(d.get("K", [])))))
+	
+	def __len__(self):
+		return len(self.nums)
+	
+	def find_all(self, role): # object numbers of the elements with a role
+		return [self.nums[pos] for pos in self.by_role.get(role, [])]
+	
+	def depth(self, num): # the depth of an element, or None if it is not in the tree
+		pos = self.positions.get(num)
+		return self.depths[pos] if pos is not None else None
+
+class CompactTree: # the whole structure tree in flat arrays, with all its text
+	# For large documents: a node takes a few dozen bytes instead of an object
+	# for every element and piece of content, and nothing refers back to the
+	# document, which can be closed once the tree is built. Nodes are numbered
+	# in document order, the root being node 0; the kids of a node are found
+	# from firstkids and nextsiblings. The text of all the marked content is
+	# kept in one string, each node having an offset and length in it.
+	# Nodes are read through CompactElem and CompactContent views, which give
+	# the same attributes as StructElem and MarkedContent. It is built from
+	# the elements' dictionaries, as StructureIndex is, so the elements are
+	# not loaded into the document's cache, only the pages
+	ELEM = 1
+	CONTENT = 2
+	OBJECT = 3 # an object reference, such as an image, given as None in kids
+	
+	def __init__(self, doc, root):
+		self.kinds = array.array("B")
+		self.parents = array.array("l") # the parent node, -1 for the root
+		self.firstkids = array.array("l") # -1 if there are no kids
+		self.nextsiblings = array.array("l") # -1 for the last kid
+		self.values = array.array("l") # role id of an element, MCID of content
+		self.pages = array.array("l") # page index (counting from 0), or -1
+		self.textstarts = array.array("L")
+		self.textlens = array.array("L")
+		self.subtypes = ["/StructTreeRoot"] # by role id, each stored once
+		self.roles = [None] # the same after the RoleMap, e.g. "H1"
+		roleids = {}
+		pageindices = dict((page.num, i)
+			for (i, page) in enumerate(doc.rootnode.pages.pages))
+		textparts = []
+		textsize = 0
+		releaser = PageReleaser() # the content is released as the walk moves on
+		self.add_node(-1, -1, self.ELEM, 0, -1)
+		# (the element's /Pg, its node, the iterator over its kids, its last
+		# kid node) for each open element
+		stack = [[None, 0, iter(root.kidrefs), -1]]
+		while stack:
+			top = stack[-1]
+			(pageref, node, kidrefs, lastkid) = top
+			ref = next(kidrefs, _missing)
+			if ref is _missing: # finished with this element
+				stack.pop()
+				continue
+			if type(ref) == PDFRef:
+				d = doc.get_value(get_reference(ref))
+				if type(d) == dict and "S" in d: # a structure element
+					subtype = d["S"]
+					roleid = roleids.get(subtype)
+					if roleid is None:
+						roleid = roleids[subtype] = len(self.subtypes)
+						self.subtypes.append(subtype)
+						self.roles.append(doc.map_role(subtype))
+					page = -1
+					if d.get("Pg") is not None:
+						page = pageindices.get(get_reference(d["Pg"]), -1)
+					top[3] = self.add_node(node, lastkid, self.ELEM, roleid, page)
+					stack.append([d.get("Pg"), top[3], iter(kid_list(d.get("K", []))), -1])
+					continue
+				ref = None # an object reference, such as an image
+			if type(ref) == dict and ref.get("Type") != "/OBJR": # marked content
+				(mcid, kidpageref) = (ref["MCID"], ref.get("Pg", pageref))
+			elif type(ref) == int: # an MCID on the element's page
+				(mcid, kidpageref) = (ref, pageref)
 			else:
-				self.kids.append(self.page.contents.get_mc(ref))
-			
+				top[3] = self.add_node(node, lastkid, self.OBJECT, 0, -1)
+				continue
+			if kidpageref is None:
+				raise Exception("Cannot find the page of MCID " + str(mcid))
+			page = doc.get_object(get_reference(kidpageref))
+			releaser.visit(page)
+			text = page.get_mc(mcid).text
+			top[3] = self.add_node(node, lastkid, self.CONTENT, int(mcid),
+				pageindices.get(page.num, -1), textsize, len(text))
+			textparts.append(text)
+			textsize += len(text)
+		releaser.close()
+		self.text = u"".join(textparts)
+	
+	def add_node(self, parent, lastkid, kind, value, page, textstart=0, textlen=0):
+		# append a node after lastkid, the last node added to parent so far
+		node = len(self.kinds)
+		self.kinds.append(kind)
+		self.parents.append(parent)
+		self.firstkids.append(-1)
+		self.nextsiblings.append(-1)
+		self.values.append(value)
+		self.pages.append(page)
+		self.textstarts.append(textstart)
+		self.textlens.append(textlen)
+		if lastkid >= 0:
+			self.nextsiblings[lastkid] = node
+		elif parent >= 0:
+			self.firstkids[parent] = node
+		return node
+	
+	def __len__(self):
+		return len(self.kinds)
+	
+	@property
+	def root(self): # the view of the root, whose kids are the top-level elements
+		return CompactElem(self, 0)
+	
+	def view(self, node): # the kid a node stands for
+		kind = self.kinds[node]
+		if kind == self.ELEM:
+			return CompactElem(self, node)
+		if kind == self.CONTENT:
+			return CompactContent(self, node)
+		return None
+	
+	def get_text(self, node): # the text of a marked content node
+		start = self.textstarts[node]
+		return self.text[start:start + self.textlens[node]]
+	
+	def save(self, path): # see save_snapshot
+		save_snapshot(self, path)
+	
+	def iter_kids(self, node): # the nodes of the kids of a node, in order
+		kid = self.firstkids[node]
+		while kid >= 0:
+			yield kid
+			kid = self.nextsiblings[kid]
+	
+	def iter_structure(self):
+		# (depth, kid) pairs for every node below the root, depth-first, as
+		# PDFDocument.iter_structure gives them. Nodes are already in this
+		# order, so only the depths need following
+		path = [0] # the open elements, innermost last
+		for node in xrange(1, len(self.kinds)):
+			parent = self.parents[node]
+			while path[-1] != parent:
+				path.pop()
+			yield (len(path)-1, self.view(node))
+			if self.kinds[node] == self.ELEM:
+				path.append(node)
+	
+	def depth(self, node): # 0 for a top-level element, -1 for the root
+		depth = -1
+		while node > 0:
+			node = self.parents[node]
+			depth += 1
+		return depth
+
+class CompactElem(object): # a view of an element node of a CompactTree
+	__slots__ = ("tree", "node")
+	
+	def __init__(self, tree, node):
+		self.tree = tree
+		self.node = node
+	
+	def __eq__(self, other):
+		return (isinstance(other, CompactElem) and other.tree is self.tree and
+			other.node == self.node)
+	
+	def __ne__(self, other):
+		return not self == other
+	
+	def __hash__(self):
+		return hash(self.node)
+	
+	@property
+	def subtype(self): # e.g. "/P"
+		return self.tree.subtypes[self.tree.values[self.node]]
+	
+	@property
+	def role(self): # the standard structure type, after the RoleMap, e.g. "P"
+		return self.tree.roles[self.tree.values[self.node]]
+	
+	@property
+	def pageindex(self): # the index of the element's page, or None
+		page = self.tree.pages[self.node]
+		return page if page >= 0 else None
+	
+	@property
+	def kids(self):
+		return [self.tree.view(kid) for kid in self.tree.iter_kids(self.node)]
+	
+	@property
+	def parent(self): # None at the top of the tree
+		parent = self.tree.parents[self.node]
+		return CompactElem(self.tree, parent) if parent > 0 else None
+	
+	@property
+	def depth(self):
+		return self.tree.depth(self.node)
+	
+	def ancestors(self): # the parent, its parent and so on up to the top
+		elem = self.parent
+		while elem is not None:
+			yield elem
+			elem = elem.parent
+
+class CompactContent(object): # a view of a marked content node of a CompactTree
+	__slots__ = ("tree", "node")
+	
+	def __init__(self, tree, node):
+		self.tree = tree
+		self.node = node
+	
+	@property
+	def mcid(self):
+		return self.tree.values[self.node]
+	
+	@property
+	def text(self):
+		return self.tree.get_text(self.node)
+	
+	@property
+	def pageindex(self): # the index of the page the content is on, or None
+		page = self.tree.pages[self.node]
+		return page if page >= 0 else None
+	
+	@property
+	def parent(self):
+		return CompactElem(self.tree, self.tree.parents[self.node])
+
+_framed_header = struct.Struct("<8sHBBQI")
+
+def write_framed(path, magic, version, payload):
+	# write payload to a file with a header: magic, format version, the item
+	# size and byte order of the arrays in the payload, and its length and
+	# CRC-32. It is written to a temporary file first, so a reader never
+	# sees half of it. Used by IndexFile, save_snapshot and TextIndex
+	header = _framed_header.pack(magic, version, array.array("l").itemsize,
+		sys.byteorder == "big", len(payload), zlib.crc32(payload) & 0xffffffff)
+	tmp = "%s.%d.tmp" % (path, os.getpid())
+	fout = open(tmp, "wb")
+	try:
+		fout.write(header)
+		fout.write(payload)
+	finally:
+		fout.close()
+	os.rename(tmp, path)
+
+def read_framed(data, magic, version, what, verify=True):
+	# check the header of a file written by write_framed, given its bytes (a
+	# string or mmap), and return where the payload starts. what names the
+	# format in errors; verify=False skips checking the CRC-32
+	if len(data) < _framed_header.size:
+		raise Exception("Not a " + what)
+	(filemagic, fileversion, itemsize, bigendian, length,
+		crc) = _framed_header.unpack_from(data)
+	if filemagic != magic:
+		raise Exception("Not a " + what)
+	if fileversion != version:
+		raise Exception("Unsupported %s version %d" % (what, fileversion))
+	if itemsize != array.array("l").itemsize or bigendian != (sys.byteorder == "big"):
+		raise Exception("The %s was written on another platform" % what)
+	pos = _framed_header.size
+	if len(data) != pos + length or (verify and
+			zlib.crc32(data[pos:]) & 0xffffffff != crc):
+		raise Exception("The %s is truncated or corrupt" % what)
+	return pos
+
+SNAPSHOT_MAGIC = "PDFSNAP\0"
+SNAPSHOT_VERSION = 2
+_snapshot_sizes = struct.Struct("<QQ") # the number of nodes and length of the text
+_snapshot_columns = [("kinds", "B"), ("parents", "l"), ("firstkids", "l"),
+	("nextsiblings", "l"), ("values", "l"), ("pages", "l"), ("textstarts", "L"),
+	("textlens", "L")] # in the order they are stored
+
+def save_snapshot(tree, path):
+	# write a CompactTree to a snapshot file, which load_snapshot maps. The
+	# payload (see write_framed) has the number of nodes and the length of
+	# the text, the subtypes and roles, each node column of the tree in
+	# turn, and the text in UTF-8, which the text columns index by byte
+	parts = [None, struct.pack("<I", len(tree.subtypes))]
+	for (subtype, role) in zip(tree.subtypes, tree.roles):
+		role = role or ""
+		parts.append(struct.pack("<H", len(subtype)) + subtype)
+		parts.append(struct.pack("<H", len(role)) + role)
+	texts = [tree.get_text(node).encode("utf-8") if tree.kinds[node] == tree.CONTENT
+		else "" for node in xrange(len(tree))]
+	columns = dict((name, getattr(tree, name)) for (name, typecode) in _snapshot_columns)
+	columns["textlens"] = array.array("L", [len(text) for text in texts])
+	columns["textstarts"] = array.array("L", [0]) * len(tree)
+	pos = 0
+	for (node, size) in enumerate(columns["textlens"]):
+		columns["textstarts"][node] = pos
+		pos += size
+	for (name, typecode) in _snapshot_columns:
+		parts.append(array.array(typecode, columns[name]).tostring())
+	parts.extend(texts)
+	parts[0] = _snapshot_sizes.pack(len(tree), pos)
+	write_framed(path, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, "".join(parts))
+
+def load_snapshot(path, verify=False):
+	# a SnapshotTree of a file written by save_snapshot. The file is mapped,
+	# and nodes and text are read from it as they are used, so loading does
+	# not depend on the size of the tree. verify=True also checks the
+	# CRC-32 of the whole file
+	fin = open(path, "rb")
+	try:
+		if os.fstat(fin.fileno()).st_size < _framed_header.size:
+			raise Exception("Not a structure snapshot: " + path)
+		buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+	finally:
+		fin.close() # the mapping stays valid after the file is closed
+	try:
+		return SnapshotTree(buf, verify)
+	except:
+		buf.close()
+		raise
+
+class MappedColumn: # a read-only array kept in a buffer, read an item at a time
+	def __init__(self, buf, pos, typecode, count):
+		self.buf = buf
+		self.pos = pos
+		self.item = struct.Struct(typecode)
+		self.count = count
+	
+	def __len__(self):
+		return self.count
+	
+	def __getitem__(self, i):
+		if i < 0:
+			i += self.count
+		if i < 0 or i >= self.count:
+			raise IndexError("column index out of range")
+		return self.item.unpack_from(self.buf, self.pos + i*self.item.size)[0]
+
+class SnapshotTree(CompactTree): # a CompactTree read from a snapshot, see load_snapshot
+	def __init__(self, buf, verify=False):
+		pos = read_framed(buf, SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+			"structure snapshot", verify)
+		(count, textsize) = _snapshot_sizes.unpack_from(buf, pos)
+		pos += _snapshot_sizes.size
+		self.buf = buf
+		(n,) = struct.unpack_from("<I", buf, pos)
+		pos += 4
+		self.subtypes = []
+		self.roles = []
+		for i in range(n):
+			for names in (self.subtypes, self.roles):
+				(size,) = struct.unpack_from("<H", buf, pos)
+				names.append(buf[pos+2:pos+2+size])
+				pos += 2 + size
+		self.roles[0] = None # the root's
+		for (name, typecode) in _snapshot_columns:
+			column = MappedColumn(buf, pos, typecode, count)
+			setattr(self, name, column)
+			pos += count * column.item.size
+		self.textpos = pos
+		if pos + textsize != len(buf):
+			raise Exception("The structure snapshot is truncated or corrupt")
+	
+	def get_text(self, node):
+		start = self.textpos + self.textstarts[node]
+		return self.buf[start:start + self.textlens[node]].decode("utf-8")
+	
+	def close(self): # release the mapping; the tree cannot be used after
+		self.buf.close()
+
+TEXT_INDEX_MAGIC = "PDFTIDX\0"
+TEXT_INDEX_VERSION = 1
+_word_re = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text): # the words of some text, in lower case, for a TextIndex
+	return [word.lower() for word in _word_re.findall(text)]
+
+Hit = namedtuple("Hit", "document path page mcid") # a match found by a TextIndex
+
+def format_path(steps): # e.g. "Table 3 > TR 5 > TD 2", see TextIndex
+	return " > ".join("%s %d" % step for step in steps)
+
+class IndexedDocument: # what a TextIndex keeps of one document
+	def __init__(self, name):
+		self.name = name
+		self.paths = [] # structure paths, each a tuple of (role, n) steps
+		# the path, page index (or -1) and MCID of each piece of marked
+		# content, three items each
+		self.contents = array.array("l")
+
+class TextIndex: # an inverted index of the words of the marked content of documents
+	# Each word maps to its postings: (document, piece of marked content,
+	# position of the word in it) triples, flattened into one array. A piece
+	# of content is found by its structure path, each step of which is the
+	# role of an element and which of the elements of that role among its
+	# parent's kids it is, counting from 1: ("Table", 3), ("TR", 5), ("TD", 2)
+	# is the second cell of the fifth row of the third Table. Indexes can be
+	# saved, loaded and merged, and searched without the PDFs
+	def __init__(self):
+		self.documents = [] # IndexedDocument, by number
+		self.postings = {} # word -> array of (document, content, position)
+	
+	def add_document(self, doc, name=None):
+		# index a PDFDocument, walking its tree as compact_tree does; name
+		# identifies it in hits (by default, its path)
+		tree = doc.compact_tree()
+		if tree is not None:
+			self.add_tree(tree, name or doc.path)
+	
+	def add_tree(self, tree, name):
+		# index a CompactTree, or a SnapshotTree from load_snapshot
+		docnum = len(self.documents)
+		indexed = IndexedDocument(name)
+		self.documents.append(indexed)
+		pathnums = {} # path -> its number
+		path = [0] # the open element nodes, innermost last
+		steps = [] # the step of the path for each of them below the root
+		counts = [{}] # for each, the number of its kids of each role so far
+		for node in xrange(1, len(tree)):
+			parent = tree.parents[node]
+			while path[-1] != parent:
+				path.pop()
+				steps.pop()
+				counts.pop()
+			kind = tree.kinds[node]
+			if kind == tree.ELEM:
+				role = tree.roles[tree.values[node]]
+				counts[-1][role] = counts[-1].get(role, 0) + 1
+				path.append(node)
+				steps.append((role, counts[-1][role]))
+				counts.append({})
+			elif kind == tree.CONTENT:
+				key = tuple(steps)
+				pathnum = pathnums.get(key)
+				if pathnum is None:
+					pathnum = pathnums[key] = len(indexed.paths)
+					indexed.paths.append(key)
+				content = len(indexed.contents) // 3
+				indexed.contents.extend((pathnum, tree.pages[node], tree.values[node]))
+				for (pos, word) in enumerate(tokenize(tree.get_text(node))):
+					postings = self.postings.get(word)
+					if postings is None:
+						postings = self.postings[word] = array.array("l")
+					postings.extend((docnum, content, pos))
+	
+	def merge(self, other): # add the documents of another TextIndex to this one
+		offset = len(self.documents)
+		self.documents.extend(other.documents)
+		for word in other.postings:
+			postings = array.array("l", other.postings[word])
+			for i in xrange(0, len(postings), 3):
+				postings[i] += offset
+			if word in self.postings:
+				self.postings[word].extend(postings)
+			else:
+				self.postings[word] = postings
+	
+	def search(self, query, role=None, phrase=True):
+		# Hits for the pieces of marked content holding the words of query
+		# next to each other, in order (or anywhere in the piece, with
+		# phrase=False), in the order the documents were added and in
+		# document order. With a role, e.g. "Table", only content inside an
+		# element of that role counts
+		words = tokenize(query)
+		if not words:
+			return []
+		found = None # (document, content) -> positions where a match starts
+		for (i, word) in enumerate(words):
+			postings = self.postings.get(word, [])
+			matches = {}
+			for j in xrange(0, len(postings), 3):
+				key = (postings[j], postings[j+1])
+				if found is None or key in found:
+					matches.setdefault(key, set()).add(postings[j+2] - i if phrase else 0)
+			if found is not None:
+				for key in matches:
+					matches[key] &= found[key]
+			found = dict((key, starts) for (key, starts) in matches.items() if starts)
+			if not found:
+				return []
+		hits = []
+		for (docnum, content) in sorted(found):
+			indexed = self.documents[docnum]
+			(pathnum, page, mcid) = indexed.contents[3*content:3*content+3]
+			steps = indexed.paths[pathnum]
+			if role is not None and not any(step[0] == role for step in steps):
+				continue
+			hits.append(Hit(indexed.name, format_path(steps),
+				page if page >= 0 else None, mcid))
+		return hits
+	
+	def save(self, path):
+		# write the index to a file for TextIndex.load. The payload (see
+		# write_framed) has each document's name, paths and content table, then each word
+		# with its postings. Words are in UTF-8, and roles are kept as the
+		# bytes of their PDF names. A name is marked as None, a str or a
+		# unicode string (in UTF-8), so it is loaded as it was given
+		def text(s):
+			return struct.pack("<I", len(s)) + s
+		parts = [struct.pack("<I", len(self.documents))]
+		for indexed in self.documents:
+			name = indexed.name
+			if isinstance(name, unicode):
+				parts.append(struct.pack("<B", 2) + text(name.encode("utf-8")))
+			else:
+				parts.append(struct.pack("<B", name is not None) + text(name or ""))
+			parts.append(struct.pack("<I", len(indexed.paths)))
+			for steps in indexed.paths:
+				parts.append(struct.pack("<I", len(steps)))
+				for (role, n) in steps:
+					parts.append(text(role) + struct.pack("<I", n))
+			parts.append(struct.pack("<I", len(indexed.contents)))
+			parts.append(indexed.contents.tostring())
+		parts.append(struct.pack("<I", len(self.postings)))
+		for word in sorted(self.postings):
+			parts.append(text(word.encode("utf-8")) +
+				struct.pack("<I", len(self.postings[word])))
+			parts.append(self.postings[word].tostring())
+		write_framed(path, TEXT_INDEX_MAGIC, TEXT_INDEX_VERSION, "".join(parts))
+	
+	@classmethod
+	def load(cls, path): # a TextIndex saved with save
+		fin = open(path, "rb")
+		try:
+			data = fin.read()
+		finally:
+			fin.close()
+		payload = data[read_framed(data, TEXT_INDEX_MAGIC, TEXT_INDEX_VERSION,
+			"text index"):]
+		itemsize = array.array("l").itemsize
+		pos = [0] # where reading has got to in payload
+		def number():
+			pos[0] += 4
+			return struct.unpack_from("<I", payload, pos[0]-4)[0]
+		def text(): # the bytes, as written by save
+			n = number()
+			pos[0] += n
+			return payload[pos[0]-n:pos[0]]
+		def column(n):
+			values = array.array("l")
+			values.fromstring(payload[pos[0]:pos[0]+n*itemsize])
+			pos[0] += n*itemsize
+			return values
+		index = cls()
+		for i in range(number()):
+			pos[0] += 1
+			kind = ord(payload[pos[0]-1])
+			name = text()
+			indexed = IndexedDocument((None, name, name.decode("utf-8"))[kind])
+			for j in range(number()):
+				indexed.paths.append(tuple((text(), number()) for k in range(number())))
+			indexed.contents = column(number())
+			index.documents.append(indexed)
+		for i in range(number()):
+			word = text().decode("utf-8")
+			index.postings[word] = column(number())
+		return index
+
+class NumberTree: # a number tree, such as the ParentTree, read as it is searched
+	def __init__(self, doc, root):
+		self.doc = doc
+		self.nodes = {} # nodes read so far, by object number
+		self.root = self.get_node(root)
+	
+	def get_node(self, ref):
+		if type(ref) == PDFRef:
+			num = get_reference(ref)
+			if num not in self.nodes:
+				self.nodes[num] = self.get_node(self.doc.get_value(num))
+			return self.nodes[num]
+		if type(ref.get("Nums")) == list: # a leaf: index its [key value ...] array
+			nums = ref["Nums"]
+			ref["Nums"] = dict(zip(nums[0::2], nums[1::2]))
+		return ref
+	
+	def get(self, key): # the value for key, or None
+		node = self.root
+		while "Nums" not in node:
+			for kid in node.get("Kids", []):
+				kid = self.get_node(kid)
+				(first, last) = kid.get("Limits", (key, key))
+				if first <= key <= last:
+					node = kid
+					break
+			else:
+				return None
+		return node["Nums"].get(key)
+
 class ObjStm(PDFObj): # object stream containing compressed PDF objects
-	def __init__(self, doc, str, di):
+	def __init__(self, doc, buf, pos, end, di):
 		PDFObj.__init__(self, doc, "ObjStm")
 		
-		self.xreftable = {}
-		self.objects = {}
-		
-		startstream = str.find("stream")+6
-		endstream = str.rfind("endstream")
-		# we need to remove the newlines:
-		# if using UNIX newlines, remove 1 char, else remove 2 (Windows newlines)
-		startstream += 2 if str[startstream] == '\r' else 1
-		endstream -= 2 if str[endstream-1] == '\r' else 1
-		str = str[startstream:endstream]
-		if di["Filter"]=="/FlateDecode":
-			dec = zlib.decompress(str) # decompress it
-			self.dec = dec
-		else:
-			raise Exception("Unknown stream format: " + di["Filter"])
+		# id -> (start, end) of each object in the stream. The header is only
+		# read when the table is needed and is not already known from an
+		# IndexFile, see PDFDocument.get_objstm
+		self.xreftable = None
 		
-		first_offset = int(di["First"]) # jump to first object position
+		(start, stop) = stream_extent(doc, buf, pos, end, di)
+		filters = stream_filters(di)
+		if filters and filters != ["/FlateDecode"]:
+			raise Exception("Unknown stream format: " + " ".join(filters))
+		self.stmdata = (buf, start, stop, filters) # to inflate it again
+		self.header = (di["First"], di["N"])
+	
+	def get_xreftable(self):
+		if self.xreftable is None:
+			self.read_header()
+		return self.xreftable
+	
+	def read_header(self):
+		dec = self.get_data()
+		(first_offset, n) = self.header # jump to first object position
 		
-		id_offsets = dec[:first_offset].replace('\n', " ").replace('\r', "").split(" ") # remove newlines from the id list
-		i = 0
-		while i < len(id_offsets)-1: # last element is garbage
-			id = int(id_offsets[i]) # get the id
-			offset = int(id_offsets[i+1]) + first_offset # calculate the offset
-			self.xreftable[id] = offset # store in the xref-table
-			i += 2
+		# the header is N pairs of integers: object id and offset from First.
+		# Each object ends where the next one (by offset) starts
+		id_offsets = dec[:first_offset].split()
+		ids = [int(id_offsets[i]) for i in range(0, 2*n, 2)]
+		offsets = [int(id_offsets[i])+first_offset for i in range(1, 2*n, 2)]
+		ends = sorted(offsets)[1:] + [len(dec)]
+		if offsets != sorted(offsets):
+			ends = dict(zip(sorted(offsets), ends))
+			ends = [ends[offset] for offset in offsets]
+		self.xreftable = {}
+		for (id, offset, end) in zip(ids, offsets, ends):
+			self.xreftable[id] = (offset, end) # store in the xref-table
 	
-	def load_object(self, id, offset, forcetype=None):
-		end = self.dec.rfind("\n", offset)
-		str = self.dec[offset:end]
-		o = do_load_object(self.doc, str, forcetype) # load the object
-		self.objects[id] = o # store the new object for lookup later
-		return o
+	def get_data(self): # the inflated stream, which is decompressed on demand
+		if getattr(self, "dec", None) is None:
+			# it may have been inflated already, see PDFDocument.inflate_streams
+			self.dec = self.doc.inflated.pop(file_offset(*self.stmdata[:2]), None)
+			if self.dec is None:
+				self.dec = read_stream(*self.stmdata, stats=self.doc.stats) # decompress it
+			self.set_cachesize(len(self.dec))
+		return self.dec
+	
+	def rebind(self, doc, oldbuf):
+		PDFObj.rebind(self, doc, oldbuf)
+		if self.stmdata[0] is oldbuf:
+			self.stmdata = (doc.pdfdoc,) + self.stmdata[1:]
+	
+	def release_data(self): # drop the inflated stream until it is needed again
+		self.dec = None
+		self.set_cachesize(0)
+	
+	def load_object(self, id, forcetype=None):
+		# parse in place: the object is read from its exact extent in the
+		# inflated data without copying it
+		(start, end) = self.get_xreftable()[id]
+		return do_load_object(self.doc, self.get_data(), start, end, forcetype)
+	
+	def load_all(self):
+		# parse every object in the stream which declares a type that can be
+		# loaded without forcing; returns a dict of id -> object
+		dec = self.get_data()
+		objects = {}
+		xreftable = self.get_xreftable()
+		for id in xreftable:
+			(start, end) = xreftable[id]
+			(d, pos) = read_object(dec, start, end)
+			if type(d) == dict and d.get("Type") in _batch_types:
+				objects[id] = make_object(self.doc, d, dec, pos, end)
+		return objects
 	
 	def get_object(self, ref, forcetype=None):
-		if ref in self.objects: # if we've already loaded the object
-			return self.objects[ref]
-		if ref in self.xreftable: # if we know where to load it from
-			return self.load_object(ref, self.xreftable[ref], forcetype)
+		# objects are not kept here; the document caches them
+		if ref in self.get_xreftable(): # if we know where to load it from
+			return self.load_object(ref, forcetype)
 		raise Exception("Don't know how to find object " + str(ref) +
 			" in object stream!")
 
 class PDFInfo: # the information about the PDF document
 	def __init__(self, d):
-		self.author = d["Author"]
-		self.creator = d["Creator"]
-		self.creationdate = d["CreationDate"]
-		self.moddate = d["ModDate"]
-		self.producer = d["Producer"]
+		self.author = d.get("Author")
+		self.creator = d.get("Creator")
+		self.creationdate = d.get("CreationDate")
+		self.moddate = d.get("ModDate")
+		self.producer = d.get("Producer")
 			
+class XRefIndex: # the location of every object, in columns indexed by object number
+	# kinds[n] is 0 for an unknown object, 1 for an object at byte offset
+	# fields[n] in the file, 2 for an object stored in the object stream
+	# numbered fields[n], where it is the indices[n]th object, or FREE for a
+	# free object
+	FREE = 3
+	
+	def __init__(self):
+		self.kinds = array.array("B")
+		self.fields = array.array("L")
+		self.indices = array.array("L")
+	
+	def __len__(self):
+		return len(self.kinds)
+	
+	def lookup(self, num): # returns (kind, field, index), or None
+		if num < 0 or num >= len(self.kinds) or self.kinds[num] in (0, self.FREE):
+			return None
+		return (self.kinds[num], self.fields[num], self.indices[num])
+	
+	def grow(self, size):
+		n = size - len(self.kinds)
+		if n > 0:
+			self.kinds.extend(array.array("B", [0]) * n)
+			self.fields.extend(array.array("L", [0]) * n)
+			self.indices.extend(array.array("L", [0]) * n)
+	
+	def update(self, first, kinds, fields, indices):
+		# add entries for objects first, first+1... of one xref section from
+		# sequences of column values, a kind of 0 meaning free. The table of a
+		# hybrid file may list as free the objects its XRefStm gives, so
+		# entries in use take precedence over free ones
+		end = first + len(kinds)
+		self.grow(end)
+		kinds = [kind or self.FREE for kind in kinds]
+		if not any(self.kinds[first:end]): # nothing known yet: copy in bulk
+			self.kinds[first:end] = array.array("B", kinds)
+			self.fields[first:end] = array.array("L", fields)
+			self.indices[first:end] = array.array("L", indices)
+			return
+		for i in range(len(kinds)):
+			known = self.kinds[first+i]
+			if not known or (known == self.FREE and kinds[i] != self.FREE):
+				self.kinds[first+i] = kinds[i]
+				self.fields[first+i] = fields[i]
+				self.indices[first+i] = indices[i]
+	
+	def add_older(self, older):
+		# add the entries of an older xref section, read into an XRefIndex of
+		# its own. Sections are read newest first, so they only fill in the
+		# objects no newer section lists: an object freed by an incremental
+		# update stays free
+		if not self.kinds: # the first section read
+			(self.kinds, self.fields, self.indices) = (older.kinds, older.fields,
+				older.indices)
+			return
+		self.grow(len(older))
+		for num in xrange(len(older)):
+			if older.kinds[num] and not self.kinds[num]:
+				self.kinds[num] = older.kinds[num]
+				self.fields[num] = older.fields[num]
+				self.indices[num] = older.indices[num]
+
+def png_unpredict(data, columns, bpp=1):
+	# undo the PNG predictors used by xref streams: each row of `columns`
+	# bytes is preceded by a byte giving the filter it was encoded with
+	out = []
+	prev = bytearray(columns)
+	rowlen = columns + 1
+	for start in range(0, len(data) - columns, rowlen):
+		filter = ord(data[start])
+		row = bytearray(data[start+1:start+rowlen])
+		if filter == 2: # up
+			row = bytearray([(a + b) & 0xFF for (a, b) in zip(row, prev)])
+		elif filter == 1: # sub
+			for i in range(bpp, columns):
+				row[i] = (row[i] + row[i-bpp]) & 0xFF
+		elif filter == 3: # average
+			for i in range(columns):
+				left = row[i-bpp] if i >= bpp else 0
+				row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xFF
+		elif filter == 4: # paeth
+			for i in range(columns):
+				a = row[i-bpp] if i >= bpp else 0
+				b = prev[i]
+				c = prev[i-bpp] if i >= bpp else 0
+				p = a + b - c
+				(pa, pb, pc) = (abs(p - a), abs(p - b), abs(p - c))
+				if pa <= pb and pa <= pc:
+					pred = a
+				elif pb <= pc:
+					pred = b
+				else:
+					pred = c
+				row[i] = (row[i] + pred) & 0xFF
+		out.append(row)
+		prev = row
+	return "".join(str(row) for row in out)
+
+_struct_codes = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+def unpack_columns(data, pos, widths, count):
+	# split count records starting at pos, made of big-endian fields with the
+	# given byte widths, into one sequence of values per field. Fields of
+	# width 0 are returned as None
+	record = sum(widths)
+	if all(w == 0 or w in _struct_codes for w in widths):
+		fmt = "".join(_struct_codes[w] for w in widths if w)
+		values = struct.unpack_from(">" + fmt*count, data, pos)
+		nfields = len(fmt)
+		columns = []
+		i = 0
+		for w in widths:
+			if w:
+				columns.append(values[i::nfields])
+				i += 1
+			else:
+				columns.append(None)
+		return columns
+	columns = [] # unusual widths (e.g. 3 bytes): convert each field
+	start = pos
+	for w in widths:
+		if w:
+			columns.append([code_from_bytes(data[r:r+w])
+				for r in range(start, start+record*count, record)])
+		else:
+			columns.append(None)
+		start += w
+	return columns
+
+INDEX_MAGIC = "PDFXIDX\0"
+INDEX_VERSION = 3
+INDEX_HASH_BLOCK = 65536 # bytes hashed at each end of the file for its key
+_index_key = struct.Struct("<QQ20s") # see index_key
+_index_refs = struct.Struct("<7q")
+_index_itemsize = array.array("L").itemsize
+
+def index_key(buf, st): # identifies the file an IndexFile was built from
+	# the size and modification time from os.stat, and a hash of the first
+	# and last blocks of the file, which hold the header and latest xref
+	size = len(buf)
+	h = hashlib.sha1()
+	h.update(buf[:INDEX_HASH_BLOCK])
+	h.update(buf[max(size-INDEX_HASH_BLOCK, 0):size])
+	return (size, int(st.st_mtime*1000000), h.digest())
+
+def index_path(path, index_cache): # where the IndexFile of a PDF is kept
+	if index_cache is True: # next to the PDF
+		return path + ".xrefidx"
+	name = hashlib.sha1(os.path.abspath(path)).hexdigest() + ".xrefidx"
+	return os.path.join(index_cache, name)
+
+class IndexFile: # a sidecar file caching the cross-reference data of a PDF
+	# The payload of the file (see write_framed) has the key of the PDF it
+	# was built from (see index_key), the Root, Info and StructTreeRoot refs
+	# and the trailer's Size, the trailer's ID, the XRefIndex columns, and
+	# the object table of each object stream which had been read when it
+	# was saved
+	def __init__(self, path, key):
+		self.path = path
+		self.key = key
+	
+	def load(self, doc): # returns False if the file is missing, stale or corrupt
+		try:
+			fin = open(self.path, "rb")
+			try:
+				data = fin.read()
+			finally:
+				fin.close()
+		except IOError:
+			return False
+		try:
+			return self.read(doc, data)
+		except (struct.error, ValueError, IndexError, EOFError):
+			return False
+	
+	def read(self, doc, data):
+		try:
+			payload = data[read_framed(data, INDEX_MAGIC, INDEX_VERSION, "xref index"):]
+		except Exception: # e.g. another version, or corrupt
+			return False
+		if _index_key.unpack_from(payload) != self.key: # the PDF has changed
+			return False
+		refs = _index_refs.unpack_from(payload, _index_key.size)
+		pos = _index_key.size + _index_refs.size
+		(hasid, count) = struct.unpack_from("<BH", payload, pos)
+		pos += 3
+		documentid = []
+		for i in range(count):
+			(ishex, n) = struct.unpack_from("<BH", payload, pos)
+			pos += 3
+			part = payload[pos:pos+n]
+			documentid.append(PDFHexString(part) if ishex else PDFString(part))
+			pos += n
+		(n,) = struct.unpack_from("<I", payload, pos)
+		pos += 4
+		xref = XRefIndex()
+		xref.kinds = array.array("B", payload[pos:pos+n])
+		pos += n
+		for column in (xref.fields, xref.indices):
+			column.fromstring(payload[pos:pos+n*_index_itemsize])
+			pos += n*_index_itemsize
+		(count,) = struct.unpack_from("<I", payload, pos)
+		pos += 4
+		objstm_tables = {}
+		for i in range(count):
+			(num, n) = struct.unpack_from("<II", payload, pos)
+			pos += 8
+			columns = []
+			for j in range(3): # ids, starts and ends
+				column = array.array("L")
+				column.fromstring(payload[pos:pos+n*_index_itemsize])
+				pos += n*_index_itemsize
+				columns.append(column)
+			# turned into a dict by PDFDocument.get_objstm if it is used
+			objstm_tables[num] = tuple(columns)
+		if pos != len(payload) or len(xref.fields) != len(xref.kinds):
+			return False
+		# everything was read, so the document can be set up from it
+		doc.xref = xref
+		doc.objstm_tables = objstm_tables
+		doc.rootref = PDFRef(refs[0], refs[1])
+		doc.inforef = PDFRef(refs[2], refs[3]) if refs[2] >= 0 else None
+		doc.structtreerootref = PDFRef(refs[4], refs[5]) if refs[4] >= 0 else None
+		if refs[6] >= 0:
+			doc.objectcount = refs[6]
+		if hasid:
+			doc.documentid = documentid
+		return True
+	
+	def save(self, doc): # (re)write the file for the document
+		def ref_fields(ref):
+			return (ref.num, ref.gen) if ref is not None else (-1, -1)
+		parts = [_index_key.pack(*self.key), _index_refs.pack(*(ref_fields(doc.rootref) +
+			ref_fields(doc.inforef) + ref_fields(doc.structtreerootref) +
+			(getattr(doc, "objectcount", -1),)))]
+		documentid = getattr(doc, "documentid", None)
+		parts.append(struct.pack("<BH", documentid is not None,
+			len(documentid or [])))
+		for part in documentid or []:
+			parts.append(struct.pack("<BH", isinstance(part, PDFHexString), len(part)))
+			parts.append(part)
+		parts.append(struct.pack("<I", len(doc.xref)))
+		parts.append(doc.xref.kinds.tostring())
+		parts.append(doc.xref.fields.tostring())
+		parts.append(doc.xref.indices.tostring())
+		tables = doc.objstm_tables or {}
+		parts.append(struct.pack("<I", len(tables)))
+		for num in sorted(tables):
+			columns = tables[num]
+			if isinstance(columns, dict): # (ids, starts, ends) columns
+				ids = sorted(columns)
+				columns = (ids, [columns[id][0] for id in ids],
+					[columns[id][1] for id in ids])
+			parts.append(struct.pack("<II", num, len(columns[0])))
+			for column in columns:
+				parts.append(array.array("L", column).tostring())
+		try:
+			write_framed(self.path, INDEX_MAGIC, INDEX_VERSION, "".join(parts))
+		except (IOError, OSError): # the cache is optional, e.g. on a read-only disk
+			pass
+
+SOURCE_BLOCK = 65536 # bytes read from a ByteSource at a time
+
+class ByteSource: # random access to the bytes of a PDF, see PDFDocument.from_source
+	# subclasses give the size of the file in bytes, and a method
+	# read(offset, length) returning those bytes (fewer only at the end of
+	# the file); close is only needed if they hold resources
+	size = 0
+	
+	def close(self):
+		pass
+
+class MemorySource(ByteSource): # a file already in memory, as a string
+	def __init__(self, data):
+		self.data = data
+		self.size = len(data)
+	
+	def read(self, offset, length):
+		return self.data[offset:offset+length]
+
+class FileSource(ByteSource): # a local file, read as it is needed
+	def __init__(self, path):
+		self.fin = open(path, "rb")
+		self.size = os.fstat(self.fin.fileno()).st_size
+	
+	def read(self, offset, length):
+		self.fin.seek(offset)
+		return self.fin.read(length)
+	
+	def close(self):
+		self.fin.close()
+
+class HTTPSource(ByteSource): # a file on a web server, read with range requests
+	def __init__(self, url, timeout=60):
+		self.url = url
+		self.timeout = timeout
+		# the size is in the Content-Range of any range request
+		response = self.request(0, 1)
+		try:
+			content_range = response.info().getheader("Content-Range") or ""
+		finally:
+			response.close()
+		if "/" not in content_range:
+			raise Exception("Server did not give the size of " + url)
+		self.size = int(content_range.rsplit("/", 1)[1])
+	
+	def request(self, offset, length):
+		request = urllib2.Request(self.url,
+			headers={"Range": "bytes=%d-%d" % (offset, offset+length-1)})
+		response = urllib2.urlopen(request, timeout=self.timeout)
+		if response.getcode() != 206: # the whole file, not the range
+			response.close()
+			raise Exception("Server does not support range requests for " + self.url)
+		return response
+	
+	def read(self, offset, length):
+		length = min(length, self.size - offset)
+		if length <= 0:
+			return ""
+		response = self.request(offset, length)
+		try:
+			return response.read()
+		finally:
+			response.close()
+
+class SourceWindow(str): # bytes copied from a SourceBuffer, see file_offset
+	offset = 0 # where they start in the file
+
+def file_offset(buf, pos): # the offset in the file of buf[pos], buf being the file or a window
+	return getattr(buf, "offset", 0) + pos
+
+class SourceBuffer: # a ByteSource read through an LRU cache of blocks
+	# It has the parts of the string interface used on a whole file (len,
+	# indexing, slicing, find and rfind), so PDFDocument can use it in place
+	# of a string or mmap; objects are copied out of it with window() to be
+	# parsed. On a miss, readahead more blocks are read with the one needed,
+	# in one read of the source
+	def __init__(self, source, block_size=SOURCE_BLOCK, cache_blocks=256,
+			readahead=1):
+		self.source = source
+		self.size = source.size
+		self.block_size = block_size
+		self.blocks = LRUCache(max_items=cache_blocks)
+		self.readahead = readahead
+		self.reads = 0 # reads of the source
+		self.bytes_read = 0
+	
+	def __len__(self):
+		return self.size
+	
+	def get_block(self, n):
+		data = self.blocks.get(n)
+		if data is not None:
+			return data
+		count = 1
+		while count <= self.readahead and (n+count)*self.block_size < self.size and \
+				(n+count) not in self.blocks:
+			count += 1
+		data = self.source.read(n*self.block_size, count*self.block_size)
+		self.reads += 1
+		self.bytes_read += len(data)
+		for i in range(count):
+			self.blocks.put(n+i, data[i*self.block_size:(i+1)*self.block_size])
+		return data[:self.block_size]
+	
+	def read(self, start, stop): # the bytes from start to stop
+		parts = []
+		n = start // self.block_size
+		while start < stop:
+			base = n*self.block_size
+			parts.append(self.get_block(n)[start-base:stop-base])
+			start = base + self.block_size
+			n += 1
+		return "".join(parts)
+	
+	def __getitem__(self, key):
+		if isinstance(key, slice):
+			(start, stop, step) = key.indices(self.size)
+			if step != 1:
+				raise Exception("Slices of a SourceBuffer must be contiguous")
+			return self.read(start, stop)
+		if key < 0:
+			key += self.size
+		if key < 0 or key >= self.size:
+			raise IndexError("SourceBuffer index out of range")
+		return self.get_block(key // self.block_size)[key % self.block_size]
+	
+	def find(self, sub, start=0, end=None):
+		# as str.find, searching a block (and the start of the next) at a time
+		end = self.size if end is None else min(end, self.size)
+		pos = max(start, 0)
+		while pos < end:
+			next = (pos // self.block_size + 1) * self.block_size
+			i = self.read(pos, min(end, next + len(sub) - 1)).find(sub)
+			if i >= 0:
+				return pos + i
+			pos = next
+		return -1
+	
+	def rfind(self, sub, start=0, end=None): # as str.rfind, from the end backwards
+		end = self.size if end is None else min(end, self.size)
+		start = max(start, 0)
+		pos = end
+		while pos > start:
+			first = max(start, ((pos-1) // self.block_size) * self.block_size)
+			i = self.read(first, min(end, pos + len(sub) - 1)).rfind(sub)
+			if i >= 0:
+				return first + i
+			pos = first
+		return -1
+	
+	def window(self, start, end): # a SourceWindow of the bytes from start to end
+		window = SourceWindow(self.read(start, end))
+		window.offset = start
+		return window
+	
+	def close(self):
+		self.blocks.clear()
+		self.source.close()
+
 class PDFDocument: # the main class for the document
 	def get_structure_tree(self):
-		if hasattr(self.rootnode, 'structtreeroot'):
-			return self.rootnode.structtreeroot
+		if self.structtreerootref is not None:
+			return self.get_object(get_reference(self.structtreerootref))
 		else:
-			print("PDF file does not contain structure information!")
+			# a warning, on stderr, so the output of main stays valid JSON
+			warnings.warn("PDF file does not contain structure information!")
+	
+	@lazy_attribute
+	def structtreerootref(self): # None if the document is not tagged
+		return self.rootnode.structtreerootref
+	
+	def iter_structure(self, release_pages=False):
+		# walk the structure tree depth-first without recursion, yielding a
+		# (depth, kid) pair for every StructElem, MarkedContent and ignored
+		# object reference (None) in document order; the root's kids are at
+		# depth 0. Kids are resolved from each element's references without
+		# being stored on it, and a page's content stream is only decoded when
+		# the walk reaches content on that page. With release_pages=True the
+		# decoded content of a page is dropped once the walk moves on to
+		# content on a different page, so memory use does not grow with the
+		# number of pages.
+		root = self.get_structure_tree()
+		if root is None:
+			return
+		releaser = PageReleaser()
+		stack = [(root, iter(root.kidrefs))]
+		while stack:
+			(elem, kidrefs) = stack[-1]
+			ref = next(kidrefs, _missing)
+			if ref is _missing: # finished with this element
+				stack.pop()
+				continue
+			depth = len(stack)-1
+			if elem is root:
+				kid = self.get_object(get_reference(ref))
+			else:
+				kid = elem.get_kid(ref)
+			if isinstance(kid, StructElem):
+				yield (depth, kid)
+				stack.append((kid, iter(kid.kidrefs)))
+				continue
+			if release_pages and isinstance(kid, MarkedContent):
+				releaser.visit(elem.get_kid_page(ref))
+			yield (depth, kid)
+		releaser.close()
+	
+	def extract(self, pages=None, roles=None, release_pages=False):
+		# walk only the parts of the structure tree a query needs, yielding
+		# (depth, kid) pairs as iter_structure does for the subtree of each
+		# element whose role (after the RoleMap) is in roles, e.g.
+		# set(["Table"]), in document
+		# order; each such element is at depth 0. With roles=None the subtree
+		# of each top-level element is given. With pages, a list of page
+		# indices counting from 0, only content on those pages is included.
+		# The elements holding it are found from the pages' entries in the
+		# ParentTree, so other elements are not loaded, and only the content
+		# streams of those pages are decoded (see find_page_elements). Open
+		# the document with lazy=True, so nothing else is loaded beforehand
+		root = self.get_structure_tree()
+		if root is None:
+			return
+		pagenums = None # object numbers of the selected pages
+		relevant = None # numbers of the elements to visit; None for all
+		if pages is not None:
+			pagenums = self.find_pages(pages)
+			relevant = self.find_page_elements(root, pagenums)
+		releaser = PageReleaser()
+		# the depth of each element below the selected one it is in, or None
+		stack = [(root, iter(root.kidrefs), None)]
+		while stack:
+			(elem, kidrefs, depth) = stack[-1]
+			ref = next(kidrefs, _missing)
+			if ref is _missing: # finished with this element
+				stack.pop()
+				continue
+			if type(ref) == PDFRef: # a structure element
+				num = get_reference(ref)
+				if relevant is not None and num not in relevant:
+					continue
+				kid = self.get_object(num)
+				if depth is not None:
+					kiddepth = depth+1
+				elif roles is None and elem is root:
+					kiddepth = 0
+				elif (roles is not None and isinstance(kid, StructElem) and
+						kid.role in roles):
+					kiddepth = 0
+				else:
+					kiddepth = None
+				if kiddepth is not None:
+					yield (kiddepth, kid)
+				if isinstance(kid, StructElem):
+					stack.append((kid, iter(kid.kidrefs), kiddepth))
+				continue
+			if depth is None: # content outside the selected elements
+				continue
+			if type(ref) == dict and ref.get("Type") == "/OBJR":
+				yield (depth+1, None)
+				continue
+			if pagenums is not None:
+				pageref = elem.get_kid_pageref(ref)
+				if pageref is None or get_reference(pageref) not in pagenums:
+					continue
+			kid = elem.get_kid(ref)
+			if release_pages:
+				releaser.visit(elem.get_kid_page(ref))
+			yield (depth+1, kid)
+		releaser.close()
+	
+	def find_all(self, role): # the structure elements with a role, e.g. "Table"
+		# found with the structure index, so only the elements found are loaded
+		index = self.structure_index
+		if index is None:
+			return []
+		return [self.get_object(num) for num in index.find_all(role)]
+	
+	def compact_tree(self):
+		# the whole structure tree as a CompactTree, decoding each page's
+		# content as the walk reaches it and releasing it after; the tree
+		# keeps no reference to the document. None if the document is not
+		# tagged
+		root = self.get_structure_tree()
+		if root is None:
+			return None
+		return CompactTree(self, root)
+	
+	def iter_tables(self, spans=False, columns=False, release_pages=True):
+		# each Table element (after the RoleMap) in document order, as a list
+		# of rows, each a list of the text of its cells (TH or TD). The rows
+		# are the TR elements of the table, including those in THead, TBody
+		# and TFoot; see read_table. With spans=True the RowSpan and ColSpan
+		# attributes of the cells are followed, so each cell is in the
+		# column it starts in and the other places it covers are u"". With
+		# columns=True each table is given as a list of columns instead,
+		# padded with u"" to the same length. The tables are found by a walk
+		# over the elements of the tree which decodes no content, and only
+		# the pages holding their cells have their content decoded. With
+		# release_pages, the content of a page is dropped once a table on a
+		# different page has been read
+		root = self.get_structure_tree()
+		if root is None:
+			return
+		lastpages = {}
+		stack = [self.iter_kid_elements(root)]
+		while stack:
+			elem = next(stack[-1], None)
+			if elem is None: # finished with this element
+				stack.pop()
+				continue
+			stack.append(self.iter_kid_elements(elem)) # tables may be nested
+			if elem.role != "Table":
+				continue
+			pages = {}
+			rows = self.read_table(elem, spans, pages)
+			if release_pages:
+				for pagenum in lastpages:
+					if pagenum not in pages:
+						lastpages[pagenum].release_contents()
+				lastpages = pages
+			if columns:
+				width = max([len(row) for row in rows] or [0])
+				rows = [[row[i] if i < len(row) else u"" for row in rows]
+					for i in range(width)]
+			yield rows
+		for page in lastpages.values():
+			page.release_contents()
+	
+	def read_table(self, table, spans=False, pages=None):
+		# the rows of a Table element, see iter_tables. A cell's text is the
+		# text of the marked content within it, each piece stripped and
+		# joined with spaces. The pages whose content was read are added to
+		# the dict pages, by object number, if it is given
+		trs = []
+		for elem in self.iter_kid_elements(table):
+			if elem.role == "TR":
+				trs.append(elem)
+			elif elem.role in ("THead", "TBody", "TFoot"):
+				trs.extend(kid for kid in self.iter_kid_elements(elem) if kid.role == "TR")
+		rows = [[cell for cell in self.iter_kid_elements(tr) if cell.role in ("TH", "TD")]
+			for tr in trs]
+		texts = [[self.read_cell(cell, pages) for cell in row] for row in rows]
+		if not spans:
+			return texts
+		grid = [[] for row in rows] # the text at each place, None where empty
+		for (r, row) in enumerate(rows):
+			col = 0
+			for (cell, text) in zip(row, texts[r]):
+				while col < len(grid[r]) and grid[r][col] is not None:
+					col += 1 # covered by a cell spanning from above
+				rowspan = max(1, int(cell.get_attribute("RowSpan", "/Table") or 1))
+				colspan = max(1, int(cell.get_attribute("ColSpan", "/Table") or 1))
+				for r2 in range(r, min(r + rowspan, len(rows))):
+					if len(grid[r2]) < col + colspan:
+						grid[r2].extend([None] * (col + colspan - len(grid[r2])))
+					for c2 in range(col, col + colspan):
+						grid[r2][c2] = u""
+				grid[r][col] = text
+				col += colspan
+		return [[u"" if text is None else text for text in row] for row in grid]
+	
+	def read_cell(self, cell, pages=None): # the text of a cell, see read_table
+		texts = []
+		stack = [(cell, iter(cell.kidrefs))]
+		while stack:
+			(elem, kidrefs) = stack[-1]
+			ref = next(kidrefs, _missing)
+			if ref is _missing: # finished with this element
+				stack.pop()
+				continue
+			kid = elem.get_kid(ref)
+			if isinstance(kid, StructElem):
+				stack.append((kid, iter(kid.kidrefs)))
+			elif isinstance(kid, MarkedContent):
+				if pages is not None:
+					page = elem.get_kid_page(ref)
+					pages[page.num] = page
+				if kid.text.strip():
+					texts.append(kid.text.strip())
+		return u" ".join(texts)
+	
+	def iter_kid_elements(self, elem): # the kids of an element (or the root) which are elements
+		for ref in elem.kidrefs:
+			if type(ref) == PDFRef:
+				kid = self.get_object(get_reference(ref))
+				if isinstance(kid, StructElem):
+					yield kid
+	
+	def write_tables(self, f, spans=False):
+		# write every table to the file f as CSV, in UTF-8, with an empty
+		# line after each table. Returns the number of tables written
+		writer = csv.writer(f)
+		count = 0
+		for rows in self.iter_tables(spans):
+			for row in rows:
+				writer.writerow([text.encode("utf-8") for text in row])
+			writer.writerow([])
+			count += 1
+		return count
+	
+	def save_snapshot(self, path):
+		# write the structure tree with its text to a file for load_snapshot,
+		# which reads it back without the PDF (see CompactTree)
+		tree = self.compact_tree()
+		if tree is None:
+			raise Exception("PDF file does not contain structure information!")
+		save_snapshot(tree, path)
+	
+	@lazy_attribute
+	def structure_index(self): # a StructureIndex, built on first use
+		root = self.get_structure_tree()
+		if root is None:
+			return None
+		return StructureIndex(self, root)
+	
+	@lazy_attribute
+	def rolemap(self): # the RoleMap, from custom structure types to standard ones
+		root = self.get_structure_tree()
+		if root is None or root.rolemapref is None:
+			return {}
+		if type(root.rolemapref) == PDFRef:
+			return self.get_value(get_reference(root.rolemapref))
+		return root.rolemapref
+	
+	def map_role(self, subtype): # the standard role for a structure type
+		# e.g. "/Heading1" -> "H1", following the RoleMap until reaching a
+		# type which is not mapped; the result has no slash
+		role = self.roles.get(subtype)
+		if role is None:
+			name = subtype
+			seen = set()
+			while name[1:] in self.rolemap and name not in seen:
+				seen.add(name)
+				name = self.rolemap[name[1:]]
+			role = self.roles[subtype] = name[1:]
+		return role
+	
+	def find_pages(self, indices):
+		# the object numbers of the pages with the given indices, counting
+		# from 0. Pages nodes holding none of them are skipped by their /Count
+		wanted = sorted(set(i for i in indices if i >= 0))
+		found = set()
+		index = 0 # the index of the next page in the walk
+		todo = [get_reference(self.rootnode.pagesref)]
+		while todo and wanted:
+			num = todo.pop()
+			node = self.get_object(num)
+			if isinstance(node, Pages):
+				if index + node.count <= wanted[0]:
+					index += node.count
+				else:
+					todo.extend(reversed([get_reference(ref) for ref in node.kidrefs]))
+				continue
+			if index == wanted[0]:
+				found.add(num)
+				wanted.pop(0)
+			index += 1
+		return found
+	
+	def find_page_elements(self, root, pagenums):
+		# the object numbers of the structure elements holding marked content
+		# on the given pages, and of all their ancestors: the ParentTree gives
+		# the element for each MCID on a page, from which the /P references
+		# lead up to the root. Without a ParentTree, every element is visited
+		# instead (but no content is decoded)
+		relevant = set()
+		if root.parenttreeref is None:
+			stack = [(root, None, iter(root.kidrefs))]
+			while stack:
+				(elem, num, kidrefs) = stack[-1]
+				ref = next(kidrefs, _missing)
+				if ref is _missing: # finished with this element
+					stack.pop()
+					continue
+				if type(ref) == PDFRef:
+					kid = self.get_object(get_reference(ref))
+					if isinstance(kid, StructElem):
+						stack.append((kid, get_reference(ref), iter(kid.kidrefs)))
+					continue
+				if elem is root or (type(ref) == dict and ref.get("Type") == "/OBJR"):
+					continue
+				pageref = elem.get_kid_pageref(ref)
+				if pageref is not None and get_reference(pageref) in pagenums:
+					for (elem, num, kidrefs) in reversed(stack[1:]):
+						if num in relevant:
+							break
+						relevant.add(num)
+			return relevant
+		tree = NumberTree(self, root.parenttreeref)
+		rootnum = get_reference(self.structtreerootref)
+		for num in pagenums:
+			page = self.get_object(num)
+			if page.structparents is None: # no marked content on the page
+				continue
+			parents = tree.get(page.structparents)
+			if type(parents) == PDFRef: # an array, or an element, elsewhere
+				value = self.get_value(get_reference(parents))
+				parents = value if type(value) == list else [parents]
+			for ref in parents or []:
+				while type(ref) == PDFRef:
+					elemnum = get_reference(ref)
+					if elemnum == rootnum or elemnum in relevant:
+						break
+					relevant.add(elemnum)
+					elem = self.get_object(elemnum)
+					if not isinstance(elem, StructElem):
+						break
+					ref = elem.parentref
+		return relevant
+	
+	@lazy_attribute
+	def rootnode(self):
+		return self.get_object(get_reference(self.rootref))
+	
+	@lazy_attribute
+	def info(self): # None if the document has no info dict
+		if self.inforef is None:
+			return None
+		return self.get_object(get_reference(self.inforef), "/Info")
+	
+	def load_all(self):
+		# resolve the whole object graph: every page with its fonts and content,
+		# and the full structure tree. Non-lazy documents do this when opened
+		self.info
+		for page in self.rootnode.pages.pages:
+			if page.num in self.decoded_pages:
+				continue
+			for font in page.fonts.values():
+				font.tounicode
+			page.read_contents()
+		root = self.rootnode.structtreeroot
+		if root is not None:
+			todo = list(root.kids)
+			while todo:
+				elem = todo.pop()
+				if isinstance(elem, StructElem):
+					todo.extend(elem.kids)
 	
 	def load_object(self, id, offset, forcetype=None):
-		str = self.pdfdoc[offset:]
-		start = str.find("obj")+3 # find start and end point of this object
-		end = str.find("endobj")
-		str = str[start:end].strip(" \n\r")
-		o = do_load_object(self, str, forcetype) # load the object
-		self.objects[id] = o # store the new object for lookup later
-		return o
+		(buf, start, end) = self.object_extent(offset)
+		return do_load_object(self, buf, start, end, forcetype) # load the object
+	
+	def object_extent(self, offset):
+		# (buf, start, end) giving the bytes of the object at a file offset,
+		# between "obj" and "endobj"; see window
+		buf = self.pdfdoc
+		start = buf.find("obj", offset)+3 # find start and end point of this object
+		return self.window(start, buf.find("endobj", start))
+	
+	def window(self, start, end):
+		# (buf, start, end) for the bytes of the file from start to end (or
+		# to the end of the file if end is -1), which are parsed in place in
+		# a string or mmap, but copied out of a SourceBuffer
+		buf = self.pdfdoc
+		if end < 0:
+			end = len(buf)
+		if isinstance(buf, SourceBuffer):
+			return (buf.window(start, end), 0, end-start)
+		return (buf, start, end)
 	
 	def get_object(self, ref, forcetype=None):
-		if ref in self.objects: # if object is loaded
-			return self.objects[ref] # return it
-		if ref in self.xrefstm: # if object is listed in a xref-stream
-			objstm = self.get_object(self.xrefstm[ref]) # find the stream
-			return objstm.get_object(ref, forcetype) # use it to get the object
-		if ref in self.xreftable: # if we know where to find it
-			return self.load_object(
-				ref, self.xreftable[ref], forcetype) # load the object
-		raise Exception("Don't know how to find object " + str(ref) + "!")
-	
-	def read_xref_table(self, str):
-		start_idx_count = str.find("\n")+1 # find first newline (after "xref")
-		end_idcnt = str.find("\n", start_idx_count) # find newline after
-		idcnt_text = str[start_idx_count:end_idcnt].strip(" \n\r")
-		parts = idcnt_text.split(" ") # split the index/count
-		first_idx = int(parts[0])
-		idx_count = int(parts[1])
-		offset = end_idcnt+1 # byte offset for end of current line
-		for x in range(first_idx, first_idx+idx_count, 1):
-			end_offset = str.find("\n", offset)+1 # find end of line
-			fields = str[offset:end_offset].split(" ") # split the fields
-			if fields[2][0]=="n": # if the object is in use ("n", not "f")
-				self.xreftable[x] = int(fields[0]) # add its offset to the table
-			offset = end_offset
-	
-	def read_xref_stm(self, str):
-		start = str.find("stream")+6 # find the position of the stream data
-		(d, dict_end) = read_dict(str[:start]) # read dict
-		end = str.find("endstream")
-		# we need to remove the newlines:
-		# if using UNIX newlines, remove 1 char, else remove 2 (Windows newlines)
-		start += 2 if str[start] == '\r' else 1
-		end -= 2 if str[end-1] == '\r' else 1
-		stmdata = str[start:end]
-		if d["Filter"]=="/FlateDecode": # if the filter is zlib/decompress
-			dec = zlib.decompress(stmdata) # then decode the stream data
+		o = self.objects.get(ref, _missing)
+		if o is not _missing: # if object is loaded
+			if self.stats is not None:
+				self.stats.count("cache_hits")
+			return o # return it
+		if self.stats is not None:
+			self.stats.count("cache_misses")
+			return self.stats.call("parse", self.fetch_object, ref, forcetype)
+		return self.fetch_object(ref, forcetype)
+	
+	def fetch_object(self, ref, forcetype=None): # load an object into the cache
+		entry = self.xref.lookup(ref)
+		if entry is None:
+			raise Exception("Don't know how to find object " + str(ref) + "!")
+		if entry[0] == 2: # if object is listed in a xref-stream
+			stmref = entry[1]
+			objstm = self.get_objstm(stmref) # find the stream
+			if self.objstm_batch and stmref not in self.batched_objstms:
+				o = self.load_objstm(stmref, objstm, ref, forcetype)
+			else:
+				o = objstm.get_object(ref, forcetype) # use it to get the object
+		else: # we know where to find it
+			o = self.load_object(ref, entry[1], forcetype) # load the object
+		if isinstance(o, PDFObj):
+			o.num = ref
+		# store the new object for lookup later
+		self.objects.put(ref, o, OBJECT_CACHE_OVERHEAD + getattr(o, "cachesize", 0))
+		return o
+	
+	def get_value(self, ref): # an object which is a plain value, e.g. a number
+		entry = self.xref.lookup(ref)
+		if entry is None:
+			raise Exception("Don't know how to find object " + str(ref) + "!")
+		if entry[0] == 2:
+			objstm = self.get_objstm(entry[1])
+			(start, end) = objstm.get_xreftable()[ref]
+			buf = objstm.get_data()
 		else:
-			raise Exception("Unknown stream format: " + d["Filter"])
-		first_idx = 0
-		if "Index" in d:
-			first_idx = d["Index"][0]
+			(buf, start, end) = self.object_extent(entry[1])
+		return read_object(buf, start, end)[0]
+	
+	def get_objstm(self, stmref): # an object stream, by object number
+		objstm = self.get_object(stmref)
+		if objstm.xreftable is None and self.objstm_tables is not None:
+			# reuse the stream's object table from the IndexFile, or read it
+			# and have the IndexFile updated when the document is closed
+			table = self.objstm_tables.get(stmref)
+			if table is None:
+				table = objstm.get_xreftable()
+				self.objstm_tables[stmref] = table
+				self.index_changed = True
+			elif not isinstance(table, dict): # columns, as read by IndexFile
+				(ids, starts, ends) = table
+				table = dict(zip(ids, zip(starts, ends)))
+				self.objstm_tables[stmref] = table
+			objstm.xreftable = table
+		return objstm
+	
+	def load_objstm(self, stmref, objstm, ref, forcetype=None):
+		# load every object of an object stream into the cache at once, then
+		# drop the stream's inflated data. Returns the requested object. This
+		# is only done once per stream: objects evicted from the cache later
+		# are loaded one at a time, so a small cache cannot cause repeated
+		# parsing of whole streams
+		self.batched_objstms.add(stmref)
+		objects = objstm.load_all()
+		if ref in objects:
+			o = objects.pop(ref)
+		else: # it needs a forced type, or is not loaded in a batch
+			o = objstm.get_object(ref, forcetype)
+		objstm.release_data()
+		for id in objects:
+			if id not in self.objects: # keep any instances already handed out
+				objects[id].num = id
+				self.objects.put(id, objects[id], OBJECT_CACHE_OVERHEAD)
+		self.objects.put(stmref, objstm, OBJECT_CACHE_OVERHEAD)
+		return o
+	
+	def cache_info(self): # statistics for the object cache
+		return CacheInfo(self.objects.hits, self.objects.misses,
+			self.objects.evictions, len(self.objects), self.objects.bytes)
+	
+	def read_xref_table(self, offset, xref):
+		# add the entries of the xref table at offset to xref. Each
+		# subsection is a line "first count" followed by count rows of exactly
+		# 20 bytes: "oooooooooo ggggg n" (or f, if free) and a newline
+		(buf, pos, end) = self.window(offset, self.pdfdoc.find("trailer", offset))
+		pos = buf.find("xref", pos) + 4
+		while True:
+			m = _xref_subsection_re.match(buf, pos)
+			if m is None: # reached the trailer
+				break
+			first = int(m.group(1))
+			count = int(m.group(2))
+			pos = m.end()
+			block = buf[pos:pos+20*count]
+			kinds = [1 if k == "n" else 0 for k in block[17::20]]
+			offsets = [int(block[r:r+10]) if kinds[i] else 0
+				for (i, r) in enumerate(range(0, 20*count, 20))]
+			xref.update(first, kinds, offsets, [0]*count)
+			pos += 20*count
+	
+	def read_xref_stm(self, offset, xref):
+		# add the entries of the xref stream at offset to xref; returns its dict
+		(buf, offset, end) = self.object_extent(offset)
+		(d, start) = read_object(buf, offset, end) # read dict
+		# the objects are not known yet, so the /Length must be direct
+		(start, end) = stream_extent(None, buf, start, end, d)
+		dec = read_stream(buf, start, end, stream_filters(d), self.stats)
 		wids = d["W"] # read the field widths from dict
-		wtype = wids[0] # width of type field
-		wloc = wids[1] # width of location field
-		wgen = wids[2] # width of generation number field
+		parms = d.get("DecodeParms") or {}
+		if parms.get("Predictor", 1) >= 10: # PNG predictors, one row per record
+			dec = png_unpredict(dec, parms.get("Columns", sum(wids)))
+		# the stream holds subsections of records, given as pairs of first
+		# object number and count
+		index = d.get("Index", [0, d["Size"]])
 		record_width = sum(wids) # get the total width of each record in bytes
-		offset = 0
-		id = first_idx
-		while offset<len(dec):
-			byt = dec[offset:offset+record_width] # get current record
-			typ = int_from_bytes(byt[0:wtype])
-			loc = int_from_bytes(byt[wtype:wtype+wloc])
-			gen = int_from_bytes(byt[wtype+wloc:])
-			
-			if typ==1: # if type is non-compressed
-				self.xreftable[id] = loc # store it in the usual xref-table
-			elif typ==2: # if type is compressed
-				# loc is obj number of obj stream
-				# gen is index in obj stream -> not needed
-				self.xrefstm[id] = loc
-			offset += record_width
-			id += 1
-		
-		# get the root object
-		self.rootnode = self.get_object(get_reference(d["Root"]))
-		# get the info object
-		self.info = self.get_object(get_reference(d["Info"]), "/Info")
-	
-	def read_trailer(self, str):
-		(d, dict_end) = read_dict(str) # read the dict
-		self.objectcount = int(d["Size"]) # get the total number of objects
-		if "ID" in d: # if trailer has a document id
-			self.documentid = d["ID"]
-		if "XRefStm" in d: # if trailer has a cross-reference stream
-			self.read_xref_stm(self.pdfdoc[int(d["XRefStm"]):])
-		if "Prev" in d: # if trailer has a previous cross-reference table
-			self.read_xref_table(self.pdfdoc[int(d["Prev"]):])
-		
-		# get the root object
-		self.rootnode = self.get_object(get_reference(d["Root"]))
-		# get the info object
-		self.info = self.get_object(get_reference(d["Info"]), "/Info")
+		pos = 0
+		for i in range(0, len(index)-1, 2):
+			(first, count) = (index[i], index[i+1])
+			count = min(count, (len(dec) - pos) // record_width)
+			(kinds, locs, gens) = unpack_columns(dec, pos, wids, count)
+			if kinds is None: # the type defaults to 1 (non-compressed)
+				kinds = [1] * count
+			# for compressed objects loc is the number of the object stream
+			# and gen is the index of the object within it
+			if gens is None:
+				gens = [0] * count
+			kinds = [k if k in (1, 2) else 0 for k in kinds]
+			xref.update(first, kinds, locs, gens)
+			pos += count * record_width
+		return d
+	
+	def read_trailer(self, offset): # the dict of the trailer at offset
+		(buf, offset, end) = self.window(offset, self.pdfdoc.find("startxref", offset))
+		return read_object(buf, buf.find("<<", offset), end)[0]
 	
-	def __init__(self, str):
-		str = str.rstrip() # remove any extra newlines from the end of the file
+	def close(self): # release the file mapping when opened with from_path
+		if self.index_changed:
+			self.index_file.save(self)
+			self.index_changed = False
+		if isinstance(self.pdfdoc, (mmap.mmap, SourceBuffer)):
+			self.pdfdoc.close()
+	
+	@classmethod
+	def from_buffer(cls, buf, **kwargs):
+		# buf may be a string or an mmap; all parsing is done with offsets into
+		# it, so only the bytes of each object that is loaded get copied
+		return cls(buf, **kwargs)
+	
+	@classmethod
+	def from_source(cls, source, block_size=SOURCE_BLOCK, cache_blocks=256,
+			readahead=1, **kwargs):
+		# read the file from a ByteSource (e.g. FileSource(path) or
+		# HTTPSource(url)) through a SourceBuffer, so only the blocks holding
+		# the xref data and the objects which are loaded are read. Open with
+		# lazy=True to read no more than that; doc.pdfdoc.reads and
+		# .bytes_read count what was read
+		return cls(SourceBuffer(source, block_size, cache_blocks, readahead), **kwargs)
+	
+	@classmethod
+	def from_path(cls, path, index_cache=None, processes=None, **kwargs):
+		# map the file instead of reading it, so the OS pages in only the parts
+		# of the file which are actually parsed. With index_cache=True the
+		# cross-reference data is kept in an IndexFile next to the PDF, or
+		# give a directory to keep the index files there; opening the file
+		# again then skips reading the xref sections and trailer. With
+		# processes=N, the content of the pages is decoded by N worker
+		# processes (see decode_pages) before anything else is loaded
+		fin = open(path, "rb")
+		try:
+			buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+			st = os.fstat(fin.fileno())
+		finally:
+			fin.close() # the mapping stays valid after the file is closed
+		if index_cache:
+			kwargs["index_file"] = IndexFile(index_path(path, index_cache),
+				index_key(buf, st))
+		lazy = kwargs.pop("lazy", False)
+		doc = cls.from_buffer(buf, lazy=lazy or processes is not None, **kwargs)
+		doc.path = path
+		if processes is not None:
+			doc.decode_pages(processes)
+			if not lazy:
+				doc.lazy = False
+				doc.load_all()
+		return doc
+	
+	def __init__(self, str, lazy=False, max_objects=None, cache_bytes=None,
+			objstm_batch=False, index_file=None, stats=None, threads=None,
+			xref=None):
+		# with lazy=True only the xref and trailer are read here; pages, fonts,
+		# contents and structure elements are loaded when first accessed.
+		# max_objects and cache_bytes bound the cache of loaded objects, which
+		# otherwise keeps everything; evicted objects are loaded again when
+		# next needed. cache_bytes counts decoded stream data plus an estimate
+		# of OBJECT_CACHE_OVERHEAD bytes per object. With objstm_batch=True,
+		# the first object needed from an object stream causes all of its
+		# objects to be parsed, after which its inflated data is released.
+		# index_file is an IndexFile to read the cross-reference data from,
+		# which is rebuilt if it is missing or out of date. stats=True records
+		# timings and counts in a new Stats as doc.stats, or give a Stats.
+		# With threads=N, every object stream and page content stream is
+		# inflated when the document is opened, N at a time (see
+		# inflate_streams). xref is the cross-reference data of the same
+		# file from xref_state(), used instead of reading it again
 		self.pdfdoc = str # store the full text, used for byte-offsets
-		self.objects = {}
-		self.xreftable = {}
-		self.xrefstm = {}
+		self.lazy = lazy
+		self.objstm_batch = objstm_batch
+		self.batched_objstms = set() # object streams already loaded in a batch
+		self.objects = LRUCache(max_objects, cache_bytes)
+		self.roles = {} # structure type -> role, see map_role
+		self.index_file = index_file
+		self.index_changed = False
+		self.objstm_tables = None # object tables for the IndexFile, by stream
+		self.inflated = {} # stream data inflated in advance, by offset in the file
+		self.decoded_pages = {} # page number -> {MCID: MarkedContent}, see decode_pages
+		self.path = None # the file, if opened with from_path
+		self.stats = Stats() if stats is True else (stats or None)
+		if xref is not None:
+			(self.xref, self.rootref, self.inforef) = xref
+		elif self.stats is not None:
+			self.stats.call("xref", self.open_xref)
+		else:
+			self.open_xref()
+		if threads:
+			self.inflate_streams(threads)
 		
-		# find pos of xref table
-		end_xref_offset = str.rfind("\n") # after xref-offset
+		if not lazy:
+			self.load_all()
+	
+	def open_xref(self): # from the IndexFile if there is one, else from the file
+		index_file = self.index_file
+		if index_file is None or not index_file.load(self):
+			self.read_xref()
+			if index_file is not None:
+				self.objstm_tables = {}
+				index_file.save(self)
+	
+	def xref_state(self): # the cross-reference data, to give as xref= to another PDFDocument
+		return (self.xref, self.rootref, self.inforef)
+	
+	def decode_pages(self, processes=None, path=None):
+		# decode the marked content of every page in a pool of processes,
+		# each of which maps the file (path, by default the one the document
+		# was opened from) and is given the cross-reference data. Workers
+		# decode disjoint ranges of pages and return the text of each MCID,
+		# which is kept in self.decoded_pages, where Page.get_mc finds it, so
+		# the structure tree is then built without decoding anything.
+		# processes=0 decodes the pages in this process instead. The text of
+		# the whole document is held in memory; release_contents drops a
+		# page's text
+		path = path or self.path
+		if path is None:
+			raise Exception("Decoding pages in other processes needs the path of the file")
+		pagenums = [page.num for page in self.rootnode.pages.pages]
+		if processes is None:
+			processes = multiprocessing.cpu_count()
+		size = max(1, len(pagenums) // (4*max(processes, 1))) # pages per task
+		ranges = [pagenums[i:i+size] for i in range(0, len(pagenums), size)]
+		if processes == 0: # a document of its own, as a worker would have
+			doc = PDFDocument.from_path(path, lazy=True, xref=self.xref_state())
+			results = (read_page_range(doc, pagenums) for pagenums in ranges)
+		else:
+			pool = multiprocessing.Pool(processes, init_page_worker,
+				(path, self.xref_state()))
+			results = pool.imap(decode_page_range, ranges)
+		try:
+			for result in results:
+				for (num, texts) in result:
+					self.decoded_pages[num] = dict((mcid, MarkedContent(mcid, texts[mcid]))
+						for mcid in texts)
+			if processes != 0:
+				pool.close()
+		except:
+			if processes != 0:
+				pool.terminate()
+			raise
+		finally:
+			if processes == 0:
+				doc.close()
+			else:
+				pool.join()
+	
+	def inflate_streams(self, threads):
+		# inflate the data of every object stream, then of every page's
+		# content streams, on a pool of threads (zlib lets other threads run
+		# while it inflates). The data is kept in self.inflated until the
+		# ObjStm or ContentStm reading the stream takes it, so all of it is
+		# held in memory at once. Streams which fail to inflate are left to
+		# fail when they are read
+		pool = multiprocessing.pool.ThreadPool(threads)
+		try:
+			objstms = set(self.xref.fields[num] for num in range(len(self.xref))
+				if self.xref.kinds[num] == 2)
+			self.inflate_all(pool, [self.get_object(num).stmdata for num in sorted(objstms)])
+			streams = []
+			for page in self.rootnode.pages.pages:
+				key = page.contentskey
+				for num in (key if type(key) == tuple else [key]):
+					streams.append(self.stream_data(num))
+			self.inflate_all(pool, streams)
+		finally:
+			pool.terminate()
+	
+	def inflate_all(self, pool, streams):
+		# inflate each of streams, as (buf, start, stop, filters), into
+		# self.inflated using the thread pool
+		streams = [stream for stream in streams if stream is not None and
+			stream[3] == ["/FlateDecode"] and file_offset(*stream[:2]) not in self.inflated]
+		if self.stats is not None:
+			self.stats.start("inflate")
+		try:
+			results = pool.map(inflate_or_none, streams)
+		finally:
+			if self.stats is not None:
+				self.stats.stop()
+		for (stream, data) in zip(streams, results):
+			if data is not None:
+				self.inflated[file_offset(*stream[:2])] = data
+				if self.stats is not None:
+					self.stats.count("bytes_inflated", len(data))
+	
+	def stream_data(self, num):
+		# (buf, start, stop, filters) for a stream object, without loading it;
+		# None if it is not a stream in the file itself
+		entry = self.xref.lookup(num)
+		if entry is None or entry[0] != 1:
+			return None
+		(buf, start, end) = self.object_extent(entry[1])
+		(d, pos) = read_object(buf, start, end)
+		if type(d) != dict:
+			return None
+		(start, stop) = stream_extent(self, buf, pos, end, d)
+		return (buf, start, stop, stream_filters(d))
+	
+	def reopen_updated(self, buf):
+		# a PDFDocument for buf, a later revision of this document's file
+		# made by an incremental update: the same bytes, with objects and
+		# xref sections appended. Only the new xref sections are read, and
+		# the objects loaded here whose xref entries are unchanged are moved
+		# to the new document with their decoded data, so the cost is in
+		# proportion to the size of the update. Decoded page content is kept
+		# unless a font or CMap, or the fonts or contents of its page, were
+		# changed. If buf does not start with this file, it is opened from
+		# scratch. This document must not be used afterwards
+		kwargs = dict(max_objects=self.objects.max_items,
+			cache_bytes=self.objects.max_bytes, objstm_batch=self.objstm_batch,
+			stats=self.stats)
+		old = self.pdfdoc
+		# compared like index_key: the first and last blocks of the old file
+		size = len(old)
+		(head, tail) = (min(INDEX_HASH_BLOCK, size), max(size-INDEX_HASH_BLOCK, 0))
+		if len(buf) < size or buf[:head] != old[:head] or buf[tail:size] != old[tail:size]:
+			return PDFDocument(buf, lazy=self.lazy, **kwargs)
+		doc = PDFDocument(buf, lazy=True, xref=(XRefIndex(), self.rootref, self.inforef),
+			**kwargs)
+		doc.read_xref_chain(doc.find_startxref(), self.find_startxref())
+		updates = doc.xref # entries of the new sections only
+		# including objects the update frees, which are dropped from the cache
+		changed = set(num for num in xrange(len(updates)) if updates.kinds[num])
+		doc.xref = XRefIndex()
+		for column in ("kinds", "fields", "indices"):
+			setattr(doc.xref, column, array.array(getattr(self.xref, column).typecode,
+				getattr(self.xref, column)))
+		doc.xref.grow(len(updates))
+		for num in changed:
+			doc.xref.kinds[num] = updates.kinds[num]
+			doc.xref.fields[num] = updates.fields[num]
+			doc.xref.indices[num] = updates.indices[num]
+		for name in ("objectcount", "documentid"):
+			if not hasattr(doc, name) and hasattr(self, name):
+				setattr(doc, name, getattr(self, name))
+		def is_changed(num): # including objects of a changed object stream
+			return num in changed or (self.xref.kinds[num] == 2 and
+				self.xref.fields[num] in changed)
+		# decoded content depends on the fonts of its page; when that cannot
+		# be checked because objects were evicted, none of it is kept
+		stale = set() # content keys of pages whose fonts or contents changed
+		keep_content = self.objects.evictions == 0
+		for num in changed:
+			o = self.objects.entries.get(num)
+			if isinstance(o, (Font, CMap)):
+				keep_content = False
+			elif isinstance(o, Page):
+				d = doc.get_value(num)
+				resources = d.get("Resources") if type(d) == dict else None
+				if type(resources) != dict or d.get("Contents") != o.contentsref or \
+						resources.get("Font", {}) != o.fontrefs:
+					stale.add(o.contentskey)
+		for key in self.objects.entries.keys():
+			o = self.objects.entries[key]
+			if any(is_changed(num) for num in (key if type(key) == tuple else [key])):
+				continue
+			if isinstance(o, ContentStm) and (not keep_content or key in stale):
+				continue
+			size = self.objects.sizes[key]
+			if isinstance(o, PDFObj):
+				o.rebind(doc, old) # which may drop decoded data
+				size = OBJECT_CACHE_OVERHEAD + o.cachesize
+			doc.objects.put(key, o, size)
+		for num in self.decoded_pages:
+			page = self.objects.entries.get(num)
+			if keep_content and not is_changed(num) and page is not None and \
+					page.contentskey not in stale:
+				doc.decoded_pages[num] = self.decoded_pages[num]
+		doc.batched_objstms = set(num for num in self.batched_objstms if not is_changed(num))
+		doc.inflated = self.inflated # by offset, so still valid
+		doc.path = self.path
+		if not self.lazy:
+			doc.lazy = False
+			doc.load_all()
+		return doc
+	
+	def read_xref(self): # read every xref section, and the newest trailer
+		self.xref = XRefIndex()
+		self.read_xref_chain(self.find_startxref())
+	
+	def find_startxref(self): # the offset of the newest xref section
+		str = self.pdfdoc
+		# find pos of xref table, ignoring any extra newlines at the end of the
+		# file (without stripping, which would copy the whole file)
+		eof = len(str)
+		while eof > 0 and str[eof-1] in " \n\r":
+			eof -= 1
+		end_xref_offset = str.rfind("\n", 0, eof) # after xref-offset
 		end_startxref = str.rfind("\n", 0, end_xref_offset) # before xref-offset
 		# read the byte offset of xref-table
 		str_xref = str[end_startxref:end_xref_offset]
-		startxref_offset = int(str_xref.strip(" \n\r"))
-		if str[startxref_offset:startxref_offset+4] == "xref":
-			self.read_xref_table(str[startxref_offset:]) # read the table
+		return int(str_xref.strip(" \n\r"))
+	
+	def read_xref_chain(self, offset, stop=None):
+		# read the xref section at offset, then each older one that the /Prev
+		# of its trailer leads to, until reaching the section at offset stop
+		# (if given). Sections are read newest first, so that the entries of
+		# incremental updates take precedence; the newest trailer gives the
+		# Root and Info refs. Returns the number of sections read
+		seen = set()
+		while offset is not None and offset != stop and offset not in seen:
+			d = self.read_xref_section(offset)
+			if not seen: # the newest trailer
+				self.rootref = d["Root"] # the root object
+				self.inforef = d.get("Info") # the info object
+				self.objectcount = d.get("Size") # the total number of objects
+				if "ID" in d: # if trailer has a document id
+					self.documentid = d["ID"]
+			seen.add(offset)
+			offset = d.get("Prev")
+		return len(seen)
+	
+	def read_xref_section(self, offset):
+		# read the xref table (with its trailer, and the /XRefStm of a hybrid
+		# file) or xref stream at offset, which is older than any read so far;
+		# returns the trailer or stream dict
+		buf = self.pdfdoc
+		section = XRefIndex()
+		if buf[offset:offset+4] != "xref":
+			d = self.read_xref_stm(offset, section)
 		else:
-			self.read_xref_stm(str[startxref_offset:])
-		
-		# read trailer
-		end_of_objs = str.rfind("endobj")
-		start_trailer = str.rfind("trailer",end_of_objs) # find the trailer, if it exists
-		if start_trailer >= 0:
-			start_trailer_dict = str.find("<<", start_trailer) # find trailer dict
-			end_trailer_dict = str.find(">>", start_trailer_dict)+2
-			# process the trailer
-			self.read_trailer(str[start_trailer_dict:end_trailer_dict])
+			self.read_xref_table(offset, section)
+			start_trailer = buf.find("trailer", offset)
+			if start_trailer < 0:
+				raise Exception("Cannot find the trailer of the xref table at offset " +
+					str(offset))
+			d = self.read_trailer(start_trailer)
+			if "XRefStm" in d: # if trailer has a cross-reference stream
+				self.read_xref_stm(d["XRefStm"], section)
+		self.xref.add_older(section)
+		return d
+
+def json_text(s): # s as unicode, so a record can be written as JSON
+	# byte strings (paths, PDF names, messages quoting a file) are read as
+	# UTF-8 where they can be, and as latin-1 otherwise
+	if isinstance(s, unicode):
+		return s
+	try:
+		return s.decode("utf-8")
+	except UnicodeDecodeError:
+		return s.decode("latin-1")
+
+def error_text(e): # the message of an exception, for a record
+	try:
+		message = unicode(e)
+	except UnicodeError: # a message in bytes which are not ASCII
+		message = json_text(str(e))
+	return u"%s: %s" % (type(e).__name__, message)
+
+def extract_document(path): # the record for one file, see extract_many
+	# errors are returned in the record, so that one bad file cannot stop a
+	# batch. Each page's content is released once the walk has passed it
+	try:
+		doc = PDFDocument.from_path(path, lazy=True)
+		try:
+			# the tree is given as a flat list of nodes in document order, each
+			# with its depth, as trees can be nested too deeply to encode
+			structure = []
+			texts = []
+			for (depth, elem) in doc.iter_structure(release_pages=True):
+				if isinstance(elem, StructElem):
+					structure.append({"depth": depth, "role": json_text(elem.subtype[1:])})
+				elif isinstance(elem, MarkedContent):
+					structure.append({"depth": depth, "mcid": elem.mcid,
+						"text": elem.text})
+					texts.append(elem.text)
+				else: # an object reference
+					structure.append({"depth": depth})
+			return {"path": json_text(path), "ok": True, "structure": structure,
+				"text": u"\n".join(texts)}
+		finally:
+			doc.close()
+	except Exception as e:
+		return {"path": json_text(path), "ok": False, "error": error_text(e)}
+
+_page_worker_doc = None # the document of a decode_pages worker process
+
+def init_page_worker(path, xref): # set up a worker process of decode_pages
+	global _page_worker_doc
+	_page_worker_doc = PDFDocument.from_path(path, lazy=True, xref=xref)
+
+def decode_page_range(pagenums): # in a worker of decode_pages, see read_page_range
+	return read_page_range(_page_worker_doc, pagenums)
+
+def read_page_range(doc, pagenums):
+	# [(page number, {MCID: text})] for the pages of doc, for decode_pages
+	result = []
+	for num in pagenums:
+		page = doc.get_object(num)
+		mcs = page.read_contents().mcs
+		result.append((num, dict((mcid, mcs[mcid].text) for mcid in mcs)))
+		page.release_contents()
+	return result
+
+def extract_many(paths, workers=None, max_pending=None, timeout=600):
+	# extract each of paths with extract_document in a pool of worker
+	# processes, yielding the records in the order they finish. paths may be
+	# any iterable, and is only read as work is needed: at most max_pending
+	# files (default twice the number of workers) are queued or being
+	# processed at once. workers=0 works in this process instead. A file
+	# still not done timeout seconds after a worker could have taken it (its
+	# worker died, or it hangs) gets an error record, and the pool is
+	# replaced, the other files in it being started again
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	if workers == 0:
+		for path in paths:
+			yield extract_document(path)
+		return
+	if max_pending is None:
+		max_pending = 2*workers
+	pool = None
+	done = Queue.Queue() # put to by the pool's result thread, to wake the wait
+	# [path, AsyncResult, when it could have started] for each file, in the
+	# order given to the pool, which starts them in that order: a file has
+	# started at the latest once fewer than workers files are ahead of it
+	pending = []
+	paths = iter(paths)
+	try:
+		while True:
+			if pool is None:
+				# workers are replaced now and then, so memory left behind by
+				# a pathological file is given back
+				pool = multiprocessing.Pool(workers, maxtasksperchild=100)
+				for task in pending:
+					task[1] = pool.apply_async(extract_document, (task[0],),
+						callback=done.put)
+					task[2] = None
+			while len(pending) < max_pending:
+				path = next(paths, None)
+				if path is None:
+					break
+				pending.append([path, pool.apply_async(extract_document, (path,),
+					callback=done.put), None])
+			if not pending:
+				break
+			now = time.time()
+			for task in pending[:workers]:
+				if task[2] is None:
+					task[2] = now
+			finished = [task for task in pending if task[1].ready()]
+			lost = [task for task in pending
+				if task not in finished and task[2] is not None and now - task[2] > timeout]
+			for task in finished + lost:
+				pending.remove(task)
+			if lost: # its worker is dead or stuck, so it cannot be left running
+				pool.terminate()
+				pool.join()
+				pool = None
+			for task in finished:
+				yield task[1].get()
+			for task in lost:
+				yield {"path": json_text(task[0]), "ok": False,
+					"error": "Not done after %d seconds, or its worker died" % timeout}
+			if not (finished or lost):
+				# a timeout keeps the wait interruptible with Ctrl-C
+				try:
+					done.get(True, 1)
+				except Queue.Empty:
+					pass
+		pool.close()
+	except:
+		if pool is not None:
+			pool.terminate()
+		raise
+	finally:
+		if pool is not None:
+			pool.join()
+
+def main(args=None): # the command line interface, see the top of this file
+	import argparse
+	parser = argparse.ArgumentParser(prog="python -m pyPDFStructure",
+		description="Extract the structure and text of tagged PDFs as "
+			"newline-delimited JSON, one record per file.")
+	parser.add_argument("paths", nargs="+",
+		help="PDF files; - reads the paths from stdin, one per line")
+	parser.add_argument("-j", "--workers", type=int, default=None,
+		help="number of worker processes (default: one per CPU, 0: none)")
+	parser.add_argument("-t", "--timeout", type=int, default=600,
+		help="seconds to allow each file before giving up on it (default: 600)")
+	args = parser.parse_args(args)
+	paths = args.paths
+	if paths == ["-"]:
+		paths = (line.rstrip("\r\n") for line in sys.stdin if line.strip())
+	failed = 0
+	for record in extract_many(paths, args.workers, timeout=args.timeout):
+		try:
+			line = json.dumps(record)
+		except Exception as e: # not to stop the batch, though it should not happen
+			record = {"path": json_text(record["path"]), "ok": False,
+				"error": error_text(e)}
+			line = json.dumps(record)
+		if not record["ok"]:
+			failed += 1
+		sys.stdout.write(line + "\n")
+		sys.stdout.flush()
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
 
 
 # TEST STUFF BELOW
@@ -591,21 +3360,14 @@ class PDFDocument: # the main class for the document
 #doc = PDFDocument(s)
 
 #fout = open("tree.txt", "wb")
-#def dfs(fout, elem, indent=""):
+#for (depth, elem) in doc.iter_structure():
+#	indent = "--" * depth
 #	if isinstance(elem, StructElem):
 #		fout.write(indent + elem.subtype + "\n")
+#	elif isinstance(elem, MarkedContent):
+#		fout.write(indent + elem.text + "\n")
+#	elif elem is None:
+#		fout.write(indent + "<<OBJECT>>" + "\n")
 #	else:
-#		fout.write(indent + elem.type + "\n")
-#	
-#	for k in elem.kids:
-#		if isinstance(k, StructElem):
-#			dfs(fout, k, indent + "--")
-#		elif isinstance(k, MarkedContent):
-#			fout.write(indent + "--" + k.text + "\n")
-#		elif k is None:
-#			fout.write(indent + "--" + "<<OBJECT>>" + "\n")
-#		else:
-#			fout.write(indent + "--" + "<<UNKNOWN>>" + "\n")
-
-#dfs(fout, doc.get_structure_tree())
+#		fout.write(indent + "<<UNKNOWN>>" + "\n")
 #fout.close()